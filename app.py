@@ -1,20 +1,39 @@
 import os
+import base64
 import secrets
 import json
 import time
 import hmac
 import hashlib
 import requests
+from requests.adapters import HTTPAdapter
 import threading
+import queue
+import atexit
+import heapq
+import bisect
+import gzip
+import tempfile
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from urllib.parse import urlsplit
 from datetime import datetime, timezone, timedelta
 
-from flask import Flask, request, jsonify, render_template, redirect, url_for
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from flask import Flask, request, jsonify, render_template, redirect, url_for, has_request_context, send_file
 import firebase_admin
 from firebase_admin import credentials, firestore
+from google.api_core.exceptions import AlreadyExists
 import os
 from functools import wraps
 from flask import session, redirect, url_for, render_template, request, jsonify
 import pandas as pd
+import click
+import numpy as np
 
 SERVICE_ACCOUNT_PATH = "DistributorD.json"
 PROJECT_ID = "distributoriak-2025"
@@ -26,6 +45,14 @@ db = firestore.client()
 app = Flask(__name__)
 app.secret_key = os.environ.get("FLASK_SECRET_KEY", "secret-dev")
 
+def admin_required(fn):
+    @wraps(fn)
+    def _wrap(*args, **kwargs):
+        if not session.get("is_admin"):
+            return redirect(url_for("login_page"))
+        return fn(*args, **kwargs)
+    return _wrap
+
 
 ROUTE_TABLE = {
     ("malang", "surabaya"):   {
@@ -60,9 +87,15 @@ STATUS_LIST = [
 COL_QUOTES    = "tb_quote"
 COL_SHIPMENTS = "tb_pengiriman"
 COL_HISTORY   = "tb_histori"
+COL_ROUTES    = "routes"
+COL_RESI_INDEX = "resi_index"
+COL_ANALYTICS = "tb_analytics"
+COL_HISTORY_SUMMARY = "tb_histori_summary"
+COL_COLD      = "cold"   # penanda di resi_index: dokumen sudah dipindah ke file arsip
 
 WEBHOOKS_COL  = "webhook_subscribers"  
 DLQ_COL       = "webhook_deadletter"
+OUTBOX_COL    = "webhook_outbox"
 
 POST_TIMEOUT_SECS = 5
 MAX_RETRIES = 3
@@ -70,6 +103,60 @@ BACKOFF_BASE = 0.7
 
 EVENT_STATUS_UPDATED = "shipment.status.updated"
 
+FIRESTORE_BATCH_LIMIT = 500  # batas op per WriteBatch Firestore
+MAX_BATCH_QUOTES = FIRESTORE_BATCH_LIMIT
+MAX_BULK_SHIPMENTS = int(os.environ.get("MAX_BULK_SHIPMENTS", "5000"))
+MAX_BULK_STATUS_UPDATES = int(os.environ.get("MAX_BULK_STATUS_UPDATES", "1000"))
+RESI_CREATE_ATTEMPTS = 5
+SHIPMENTS_PAGE_DEFAULT = 50
+SHIPMENTS_PAGE_MAX = 500
+ANALYTICS_SHARDS = int(os.environ.get("ANALYTICS_SHARDS", "4"))
+SHIPMENT_VIEW_ENABLED = os.environ.get("SHIPMENT_VIEW_ENABLED", "0") == "1"
+SHIPMENT_VIEW_TOMBSTONE_SECS = float(os.environ.get("SHIPMENT_VIEW_TOMBSTONE_SECS", "300"))
+SSE_MAX_CLIENTS = int(os.environ.get("SSE_MAX_CLIENTS", "5000"))
+SSE_CLIENT_QUEUE_MAX = int(os.environ.get("SSE_CLIENT_QUEUE_MAX", "100"))
+SSE_REPLAY_MAX = int(os.environ.get("SSE_REPLAY_MAX", "1000"))
+SSE_HEARTBEAT_SECS = float(os.environ.get("SSE_HEARTBEAT_SECS", "15"))
+SSE_RETRY_MS = int(os.environ.get("SSE_RETRY_MS", "3000"))
+
+OUTBOX_DISPATCHER_ENABLED = os.environ.get("OUTBOX_DISPATCHER_ENABLED", "1") == "1"
+OUTBOX_WORKERS = int(os.environ.get("OUTBOX_WORKERS", "4"))
+OUTBOX_POLL_SECS = float(os.environ.get("OUTBOX_POLL_SECS", "2"))
+OUTBOX_LEASE_SECS = int(os.environ.get("OUTBOX_LEASE_SECS", "60"))
+WEBHOOK_MAX_CONCURRENCY = int(os.environ.get("WEBHOOK_MAX_CONCURRENCY", "32"))
+WEBHOOK_PER_HOST_LIMIT = int(os.environ.get("WEBHOOK_PER_HOST_LIMIT", "4"))
+DIRECT_WORKERS = int(os.environ.get("DIRECT_WORKERS", "4"))
+DIRECT_QUEUE_MAX = int(os.environ.get("DIRECT_QUEUE_MAX", "1000"))
+DIRECT_ENQUEUE_TIMEOUT_SECS = float(os.environ.get("DIRECT_ENQUEUE_TIMEOUT_SECS", "2"))
+COALESCE_WINDOW_SECS = float(os.environ.get("COALESCE_WINDOW_SECS", "0"))
+OUTBOX_PAGE_SIZE = int(os.environ.get("OUTBOX_PAGE_SIZE", "100"))
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "archive"))
+ARCHIVE_PAGE_SIZE = int(os.environ.get("ARCHIVE_PAGE_SIZE", "200"))
+ARCHIVE_JOB_INTERVAL_SECS = float(os.environ.get("ARCHIVE_JOB_INTERVAL_SECS", "0"))   # 0 = hanya via CLI
+HISTORY_COMPACT_AFTER_DAYS = int(os.environ.get("HISTORY_COMPACT_AFTER_DAYS", "365"))
+EXPORT_DIR = os.environ.get("EXPORT_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "export"))
+EXPORT_PAGE_SIZE = int(os.environ.get("EXPORT_PAGE_SIZE", "1000"))
+# batas atas export = sekarang - lag, supaya tulisan yang updated_at-nya sudah diisi tapi belum ter-commit tidak terlewat
+EXPORT_SAFETY_LAG_SECS = float(os.environ.get("EXPORT_SAFETY_LAG_SECS", "5"))
+WEBHOOK_BATCH_MAX_EVENTS = 500
+WEBHOOK_BATCH_MAX_WAIT_MS = 10000
+SUB_REGISTRY_TTL_SECS = int(os.environ.get("SUB_REGISTRY_TTL_SECS", "60"))
+BREAKER_WINDOW = int(os.environ.get("BREAKER_WINDOW", "20"))
+BREAKER_MIN_CALLS = int(os.environ.get("BREAKER_MIN_CALLS", "5"))
+BREAKER_FAILURE_RATE = float(os.environ.get("BREAKER_FAILURE_RATE", "0.5"))
+BREAKER_COOLDOWN_SECS = float(os.environ.get("BREAKER_COOLDOWN_SECS", "30"))
+
+ROUTE_CACHE_TTL_SECS = int(os.environ.get("ROUTE_CACHE_TTL_SECS", "300"))
+NEG_ROUTE_CACHE_MAX = int(os.environ.get("NEG_ROUTE_CACHE_MAX", "1024"))
+NEG_ROUTE_CACHE_TTL_SECS = int(os.environ.get("NEG_ROUTE_CACHE_TTL_SECS", "60"))
+STATUS_CACHE_MAX = int(os.environ.get("STATUS_CACHE_MAX", "5000"))
+STATUS_CACHE_TTL_SECS = int(os.environ.get("STATUS_CACHE_TTL_SECS", "15"))
+
+# Kompresi respons JSON: di bawah ambang ini body dikirim apa adanya.
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", "1024"))
+COMPRESS_LEVEL = int(os.environ.get("COMPRESS_LEVEL", "6"))
+COMPRESS_MIMETYPES = {"application/json", "application/x-ndjson"}
+
 def now_iso() -> str:
     return datetime.now(timezone.utc).isoformat()
 
@@ -84,14 +171,195 @@ def gen_resi() -> str:
     rand = secrets.token_hex(3).upper()
     return f"RESI-{ts}-{rand[:6]}"
 
+def _route_key(origin: str, destination: str):
+    return ((origin or "").strip().lower(), (destination or "").strip().lower())
+
+_route_cache = {
+    "by_id": {}, "by_pair": {},
+    "loaded_at": None, "checked_at": None, "listener": None, "resubscribe": False,
+    "hits": 0, "misses": 0, "refreshes": 0, "errors": 0,
+}
+_route_cache_lock = threading.Lock()
+_route_refresh_lock = threading.Lock()
+
+def _route_cache_replace(snaps):
+    by_id, by_pair = {}, {}
+    for s in snaps:
+        obj = s.to_dict() or {}
+        by_id[s.id] = obj
+        by_pair[(obj.get("origin"), obj.get("destination"))] = obj
+    with _route_cache_lock:
+        now = time.monotonic()
+        _route_cache.update({"by_id": by_id, "by_pair": by_pair, "loaded_at": now, "checked_at": now})
+        _route_cache["refreshes"] += 1
+    _neg_route_clear()
+
+def _route_cache_refresh():
+    # Satu thread saja yang reload; thread lain tetap pakai data lama.
+    if not _route_refresh_lock.acquire(blocking=False):
+        return
+    try:
+        _route_cache_replace(db.collection(COL_ROUTES).stream())
+        if _route_cache["resubscribe"]:
+            _route_cache_listen()
+    except Exception as e:
+        with _route_cache_lock:
+            _route_cache["checked_at"] = time.monotonic()
+            _route_cache["errors"] += 1
+        app.logger.warning(f"[RouteCache] reload gagal: {e}")
+    finally:
+        _route_refresh_lock.release()
+
+def _on_routes_snapshot(col_snapshot, changes, read_time):
+    try:
+        _route_cache_replace(col_snapshot)
+    except Exception as e:
+        # jangan unsubscribe dari thread callback; cukup tandai rusak supaya pembaca pindah ke TTL
+        _route_listener_drop(f"snapshot gagal diterapkan: {e}", unsubscribe=False)
+
+def _route_cache_listen() -> bool:
+    try:
+        _route_cache["listener"] = db.collection(COL_ROUTES).on_snapshot(_on_routes_snapshot)
+        _route_cache["resubscribe"] = False
+        return True
+    except Exception as e:
+        app.logger.warning(f"[RouteCache] listener tidak tersedia, pakai TTL {ROUTE_CACHE_TTL_SECS}s: {e}")
+        return False
+
+def _route_listener_drop(reason: str, unsubscribe: bool = True):
+    """Listener error / watch stream tertutup: kembali ke mode TTL dan coba subscribe ulang
+    pada refresh TTL berikutnya."""
+    with _route_cache_lock:
+        listener = _route_cache["listener"]
+        if listener is None:
+            return
+        _route_cache.update({"listener": None, "resubscribe": True, "checked_at": None})
+        _route_cache["errors"] += 1
+    app.logger.warning(f"[RouteCache] listener berhenti ({reason}), kembali ke TTL {ROUTE_CACHE_TTL_SECS}s")
+    if unsubscribe:
+        try:
+            listener.unsubscribe()
+        except Exception:
+            pass
+
+def _route_cache_start():
+    _route_cache_refresh()
+    _route_cache_listen()
+
+def _route_cache_stale() -> bool:
+    listener = _route_cache["listener"]
+    if listener is not None and getattr(listener, "is_active", True) is False:
+        # Watch yang berhenti karena error tidak memanggil callback lagi; deteksi di sini
+        _route_listener_drop("watch stream tertutup")
+        listener = None
+    if listener is not None and _route_cache["loaded_at"] is not None:
+        return False
+    checked_at = _route_cache["checked_at"]
+    return checked_at is None or (time.monotonic() - checked_at) >= ROUTE_CACHE_TTL_SECS
+
+def _route_cache_put(doc_id: str, doc: dict):
+    with _route_cache_lock:
+        by_id = dict(_route_cache["by_id"]); by_pair = dict(_route_cache["by_pair"])
+        old = by_id.pop(doc_id, None)
+        if old is not None:
+            by_pair.pop((old.get("origin"), old.get("destination")), None)
+        if doc is not None:
+            by_id[doc_id] = doc
+            by_pair[(doc.get("origin"), doc.get("destination"))] = doc
+        _route_cache.update({"by_id": by_id, "by_pair": by_pair})
+
+def _route_cache_stats() -> dict:
+    with _route_cache_lock:
+        hits, misses = _route_cache["hits"], _route_cache["misses"]
+        loaded_at = _route_cache["loaded_at"]
+        return {
+            "routes": len(_route_cache["by_id"]),
+            "mode": "listener" if _route_cache["listener"] is not None else "ttl",
+            "age_secs": round(time.monotonic() - loaded_at, 1) if loaded_at is not None else None,
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": round(hits / (hits + misses), 4) if (hits + misses) else None,
+            "refreshes": _route_cache["refreshes"],
+            "errors": _route_cache["errors"],
+        }
+
+# Negative cache: rute (origin, destination) yang tidak ada di Firestore, LRU + TTL.
+_neg_routes = OrderedDict()
+_neg_route_lock = threading.Lock()
+_neg_route_stats = {"hits": 0, "inserts": 0, "evictions": 0}
+
+def _neg_route_hit(key) -> bool:
+    with _neg_route_lock:
+        entry = _neg_routes.get(key)
+        if entry is None:
+            return False
+        if entry["expires_at"] <= time.monotonic():
+            del _neg_routes[key]
+            return False
+        _neg_routes.move_to_end(key)
+        entry["hits"] += 1
+        entry["last_client"] = request.remote_addr if has_request_context() else None
+        _neg_route_stats["hits"] += 1
+        return True
+
+def _neg_route_put(key):
+    with _neg_route_lock:
+        _neg_routes[key] = {
+            "expires_at": time.monotonic() + NEG_ROUTE_CACHE_TTL_SECS,
+            "hits": 0,
+            "last_client": request.remote_addr if has_request_context() else None,
+        }
+        _neg_routes.move_to_end(key)
+        _neg_route_stats["inserts"] += 1
+        while len(_neg_routes) > NEG_ROUTE_CACHE_MAX:
+            _neg_routes.popitem(last=False)
+            _neg_route_stats["evictions"] += 1
+
+def _neg_route_invalidate(key):
+    with _neg_route_lock:
+        _neg_routes.pop(key, None)
+
+def _neg_route_clear():
+    with _neg_route_lock:
+        _neg_routes.clear()
+
+def _neg_route_cache_stats(top: int = 10) -> dict:
+    with _neg_route_lock:
+        entries = sorted(_neg_routes.items(), key=lambda kv: kv[1]["hits"], reverse=True)
+        return {
+            "size": len(_neg_routes),
+            "max_size": NEG_ROUTE_CACHE_MAX,
+            "ttl_secs": NEG_ROUTE_CACHE_TTL_SECS,
+            **_neg_route_stats,
+            "top_unknown_routes": [
+                {"origin": o, "destination": d, "hits": e["hits"], "last_client": e["last_client"]}
+                for (o, d), e in entries[:top] if (o, d) not in ROUTE_TABLE
+            ],
+        }
+
 def get_route_from_firestore(origin: str, destination: str):
-    o = (origin or "").strip().lower()
-    d = (destination or "").strip().lower()
-    doc = db.collection("routes").document(f"{o}_{d}").get()
-    if doc.exists:
-        return doc.to_dict()
-    q = db.collection("routes").where("origin", "==", o).where("destination", "==", d).get()
-    return q[0].to_dict() if q else None
+    o, d = _route_key(origin, destination)
+    if _neg_route_hit((o, d)):
+        return None
+    if _route_cache_stale():
+        _route_cache_refresh()
+
+    if _route_cache["loaded_at"] is None:
+        # Cache belum pernah berhasil dimuat: lookup langsung ke Firestore.
+        doc = db.collection(COL_ROUTES).document(f"{o}_{d}").get()
+        if doc.exists:
+            return doc.to_dict()
+        q = db.collection(COL_ROUTES).where("origin", "==", o).where("destination", "==", d).limit(1).get()
+        route = q[0].to_dict() if q else None
+    else:
+        route = _route_cache["by_id"].get(f"{o}_{d}") or _route_cache["by_pair"].get((o, d))
+        with _route_cache_lock:
+            _route_cache["hits" if route else "misses"] += 1
+        route = dict(route) if route else None
+
+    if route is None:
+        _neg_route_put((o, d))
+    return route
 
 def route_info(asal: str, tujuan: str):
     fs = get_route_from_firestore(asal, tujuan)
@@ -104,8 +372,7 @@ def route_info(asal: str, tujuan: str):
             "per_kg_factor":    float(fs.get("per_kg_factor", 0.7)),
             "included_kg":      int(fs.get("included_kg", 1)),
         }
-    key = ((asal or "").strip().lower(), (tujuan or "").strip().lower())
-    return ROUTE_TABLE.get(key)
+    return ROUTE_TABLE.get(_route_key(asal, tujuan))
 
 def eta_text(days: int) -> str:
     return "1 hari" if days == 1 else f"{days} hari"
@@ -117,6 +384,15 @@ def calc_price(price_base: int, qty_kg: int, per_kg_factor: float = 0.7, include
     extra_cost = extra_kg * per_kg_factor * price_base
     return int(round(price_base + extra_cost))
 
+def calc_price_many(price_base, qty_kg, per_kg_factor, included_kg) -> np.ndarray:
+    """Versi vektor dari calc_price untuk banyak baris sekaligus."""
+    price_base = np.asarray(price_base, dtype=np.float64)
+    qty_kg = np.asarray(qty_kg, dtype=np.int64)
+    extra_kg = np.maximum(qty_kg - np.asarray(included_kg, dtype=np.int64), 0)
+    extra_cost = extra_kg * np.asarray(per_kg_factor, dtype=np.float64) * price_base
+    total = np.round(price_base + extra_cost).astype(np.int64)
+    return np.where(qty_kg <= 0, 0, total)
+
 def _first_non_empty(*vals):
     for v in vals:
         if v not in (None, "", []):
@@ -124,6 +400,10 @@ def _first_non_empty(*vals):
     return None
 
 def _date_to_ymd_or_same(x):
+    # jalur cepat: dokumen baru sudah menyimpan tanggal sebagai YYYY-MM-DD saat ditulis
+    if isinstance(x, str) and len(x) == 10 and x[4] == "-" and x[7] == "-":
+        return x
+
     if isinstance(x, dict) and "seconds" in x:
         dt = datetime.fromtimestamp(int(x["seconds"]))
         return dt.strftime("%Y-%m-%d")
@@ -139,41 +419,93 @@ def _date_to_ymd_or_same(x):
             return x
     return None
 
+# Dua bentuk dokumen shipment: "shipments" (POST /shipments: id_pembeli, asal_pengirim,
+# harga_pengiriman, ...) dan "pengiriman" (POST /api/pengiriman: id_retail, asal_supplier,
+# biaya_pengiriman, barang_dipesan, ...). Dokumen baru menyimpan field `schema`; dokumen lama
+# dideteksi dari key-nya. Tiap varian punya proyeksi key -> field kanonik yang disusun sekali
+# saat import; dokumen campuran/tak dikenal memakai rantai fallback lama (_canonical_legacy).
+SCHEMA_SHIPMENTS = "shipments"
+SCHEMA_PENGIRIMAN = "pengiriman"
+
+_CANONICAL_FALLBACKS = {   # field kanonik -> kandidat key, urutan = prioritas fallback
+    "buyer": ("id_pembeli", "nama_supplier"),
+    "origin": ("asal_pengirim", "asal_supplier"),
+    "dest": ("tujuan", "tujuan_retail"),
+    "price": ("harga_pengiriman", "biaya_pengiriman"),
+    "distributor_name": ("distributor_name", "nama_distributor"),
+    "qty": ("total_kuantitas", "kuantitas"),
+    "eta_text": ("eta_text", "eta", "estimasi_tiba"),
+    "eta_delivery_date": ("eta_delivery_date", "eta_date"),
+}
+_SCHEMA_SOURCES = {
+    SCHEMA_SHIPMENTS: {"buyer": "id_pembeli", "origin": "asal_pengirim", "dest": "tujuan",
+                       "price": "harga_pengiriman", "distributor_name": "distributor_name",
+                       "qty": "kuantitas", "eta_text": "eta_text", "eta_delivery_date": "eta_delivery_date"},
+    SCHEMA_PENGIRIMAN: {"buyer": "nama_supplier", "origin": "asal_supplier", "dest": "tujuan_retail",
+                        "price": "biaya_pengiriman", "distributor_name": "nama_distributor",
+                        "qty": "total_kuantitas", "eta_text": "eta_text", "eta_delivery_date": "eta_delivery_date"},
+}
+_CANONICAL_PASSTHROUGH = (
+    "doc_id", "no_resi", "status", "id_order", "id_retail", "nama_supplier", "nama_barang",
+    "barang_dipesan", "currency", "harga_dasar", "per_kg_factor", "included_kg", "distributor_id",
+    "eta_days", "tanggal_pembelian", "created_at", "updated_at",
+)
+
+def _compile_projection(sources: dict):
+    names = tuple(sources) + _CANONICAL_PASSTHROUGH
+    keys = tuple(sources.values()) + _CANONICAL_PASSTHROUGH
+    # key kandidat varian lain: kalau ada di dokumen, proyeksi ini tidak berlaku
+    foreign = frozenset(k for ks in _CANONICAL_FALLBACKS.values() for k in ks) - set(sources.values())
+
+    def project(d: dict) -> dict:
+        return dict(zip(names, map(d.get, keys)))
+    return project, foreign
+
+_PROJECTIONS = {name: _compile_projection(src) for name, src in _SCHEMA_SOURCES.items()}
+
+def _detect_schema(d: dict):
+    schema = d.get("schema")
+    if schema in _PROJECTIONS:
+        return schema
+    for name, (_, foreign) in _PROJECTIONS.items():
+        if d.keys().isdisjoint(foreign):
+            return name
+    return None
+
+def _canonical_legacy(d: dict) -> dict:
+    out = {k: d.get(k) for k in _CANONICAL_PASSTHROUGH}
+    for name, keys in _CANONICAL_FALLBACKS.items():
+        out[name] = _first_non_empty(*(d.get(k) for k in keys)) if name.startswith("eta") \
+            else next((d.get(k) for k in keys if d.get(k)), None)
+    return out
+
+def _canonical(d: dict) -> dict:
+    """Field kanonik sebuah dokumen shipment, apa pun bentuk penulisnya."""
+    schema = _detect_schema(d)
+    return _PROJECTIONS[schema][0](d) if schema else _canonical_legacy(d)
+
 def _normalize_doc(d: dict) -> dict:
-    items = d.get("barang_dipesan") or []
-    first_name = (items[0].get("nama_barang") if items else None) or d.get("nama_barang") or "-"
-    qty = d.get("total_kuantitas") or d.get("kuantitas") or 0
-
-    eta_text = _first_non_empty(
-        d.get("eta_text"),
-        d.get("eta"),
-        d.get("estimasi_tiba"),
-    )
-    eta_days = _first_non_empty(
-        d.get("eta_days"),
-    )
-    eta_date_raw = _first_non_empty(
-        d.get("eta_delivery_date"),
-        d.get("eta_date"),
-    )
-    eta_delivery_date = _date_to_ymd_or_same(eta_date_raw)
+    c = _canonical(d)
+    items = c["barang_dipesan"] or []
+    first_name = (items[0].get("nama_barang") if items else None) or c["nama_barang"] or "-"
+    qty = c["qty"] or 0
 
     normalized = {
-        "doc_id": d.get("doc_id"),
-        "no_resi": d.get("no_resi"),
-        "buyer": d.get("id_pembeli") or d.get("nama_supplier") or (d.get("id_retail") and f"RETAIL-{d.get('id_retail')}") or "-",
+        "doc_id": c["doc_id"],
+        "no_resi": c["no_resi"],
+        "buyer": c["buyer"] or (c["id_retail"] and f"RETAIL-{c['id_retail']}") or "-",
         "item_name": first_name,
         "qty": qty,
-        "route_origin": d.get("asal_pengirim") or d.get("asal_supplier") or "-",
-        "route_dest": d.get("tujuan") or d.get("tujuan_retail") or "-",
-        "price": d.get("harga_pengiriman") or d.get("biaya_pengiriman") or 0,
-        "status": d.get("status") or "-",
-        "tanggal_pembelian": d.get("tanggal_pembelian") or "-",
-        "created_at": d.get("created_at") or "-",
-
-        "eta_text": eta_text,
-        "eta_days": eta_days,
-        "eta_delivery_date": eta_delivery_date,
+        "route_origin": c["origin"] or "-",
+        "route_dest": c["dest"] or "-",
+        "price": c["price"] or 0,
+        "status": c["status"] or "-",
+        "tanggal_pembelian": c["tanggal_pembelian"] or "-",
+        "created_at": c["created_at"] or "-",
+
+        "eta_text": _first_non_empty(c["eta_text"]),
+        "eta_days": _first_non_empty(c["eta_days"]),
+        "eta_delivery_date": _date_to_ymd_or_same(_first_non_empty(c["eta_delivery_date"])),
     }
 
     if items and len(items) > 0:
@@ -182,41 +514,346 @@ def _normalize_doc(d: dict) -> dict:
 
     return normalized
 
-def _hmac_signature(secret: str, body_bytes: bytes) -> str:
-    mac = hmac.new(secret.encode("utf-8"), body_bytes, hashlib.sha256)
+def _hmac_signature(secret: str, body_bytes: bytes, mac=None) -> str:
+    # `mac` = objek hmac yang sudah di-key (dari registry subscriber), cukup di-copy.
+    mac = mac.copy() if mac is not None else hmac.new(secret.encode("utf-8"), digestmod=hashlib.sha256)
+    mac.update(body_bytes)
     return mac.hexdigest()
 
+# Registry subscriber in-memory, di-index per event type. Dimuat saat startup,
+# diperbarui listener on_snapshot (atau TTL) dan langsung oleh subscribe/unsubscribe.
+_sub_registry = {
+    "by_id": {}, "by_event": {},
+    "loaded_at": None, "checked_at": None, "listener": None,
+    "refreshes": 0, "errors": 0,
+}
+_sub_registry_lock = threading.Lock()
+_sub_refresh_lock = threading.Lock()
+
+def _sub_entry(sub_id: str, obj: dict) -> dict:
+    entry = dict(obj, id=sub_id)
+    entry["mac"] = hmac.new((obj.get("secret") or "").encode("utf-8"), digestmod=hashlib.sha256)
+    return entry
+
+def _sub_index(by_id: dict) -> dict:
+    by_event = {}
+    for sid, entry in by_id.items():
+        for ev in entry.get("events") or []:
+            by_event.setdefault(ev, {})[sid] = entry
+    return by_event
+
+def _sub_registry_replace(snaps):
+    by_id = {}
+    for s in snaps:
+        obj = s.to_dict() or {}
+        if obj.get("is_active"):
+            by_id[s.id] = _sub_entry(s.id, obj)
+    with _sub_registry_lock:
+        now = time.monotonic()
+        _sub_registry.update({"by_id": by_id, "by_event": _sub_index(by_id), "loaded_at": now, "checked_at": now})
+        _sub_registry["refreshes"] += 1
+
+def _sub_registry_refresh():
+    if not _sub_refresh_lock.acquire(blocking=False):
+        return
+    try:
+        _sub_registry_replace(db.collection(WEBHOOKS_COL).where("is_active", "==", True).stream())
+    except Exception as e:
+        with _sub_registry_lock:
+            _sub_registry["checked_at"] = time.monotonic()
+            _sub_registry["errors"] += 1
+        app.logger.warning(f"[SubRegistry] reload gagal: {e}")
+    finally:
+        _sub_refresh_lock.release()
+
+def _on_subscribers_snapshot(col_snapshot, changes, read_time):
+    _sub_registry_replace(col_snapshot)
+
+def _sub_registry_start():
+    _sub_registry_refresh()
+    try:
+        _sub_registry["listener"] = (db.collection(WEBHOOKS_COL).where("is_active", "==", True)
+                                     .on_snapshot(_on_subscribers_snapshot))
+    except Exception as e:
+        app.logger.warning(f"[SubRegistry] listener tidak tersedia, pakai TTL {SUB_REGISTRY_TTL_SECS}s: {e}")
+
+def _sub_registry_put(sub_id: str, obj: dict):
+    """obj=None (atau is_active False) menghapus subscriber dari registry."""
+    with _sub_registry_lock:
+        by_id = dict(_sub_registry["by_id"])
+        if obj is not None and obj.get("is_active"):
+            by_id[sub_id] = _sub_entry(sub_id, obj)
+        else:
+            by_id.pop(sub_id, None)
+        _sub_registry.update({"by_id": by_id, "by_event": _sub_index(by_id)})
+
+def _sub_registry_stats() -> dict:
+    with _sub_registry_lock:
+        loaded_at = _sub_registry["loaded_at"]
+        return {
+            "subscribers": len(_sub_registry["by_id"]),
+            "events": {ev: len(subs) for ev, subs in _sub_registry["by_event"].items()},
+            "mode": "listener" if _sub_registry["listener"] is not None else "ttl",
+            "age_secs": round(time.monotonic() - loaded_at, 1) if loaded_at is not None else None,
+            "refreshes": _sub_registry["refreshes"],
+            "errors": _sub_registry["errors"],
+        }
+
 def _load_active_subscribers(event_name: str):
-    docs = db.collection(WEBHOOKS_COL).where("is_active", "==", True).stream()
-    subs = []
-    for d in docs:
-        obj = d.to_dict()
-        if event_name in (obj.get("events") or []):
-            obj["id"] = d.id
-            subs.append(obj)
-    return subs
-
-def _dispatch_one(url: str, secret: str, event: dict):
+    stale = (_sub_registry["listener"] is None or _sub_registry["loaded_at"] is None) and (
+        _sub_registry["checked_at"] is None
+        or (time.monotonic() - _sub_registry["checked_at"]) >= SUB_REGISTRY_TTL_SECS)
+    if stale:
+        _sub_registry_refresh()
+    return list(_sub_registry["by_event"].get(event_name, {}).values())
+
+# Satu Session bersama (keep-alive) + pool thread untuk fan-out ke banyak subscriber.
+# WEBHOOK_MAX_CONCURRENCY membatasi request paralel total, WEBHOOK_PER_HOST_LIMIT per host.
+# Batas per host ditegakkan sebelum masuk pool (antrean per host), jadi worker pool tidak
+# pernah menunggu slot host lambat sementara subscriber lain mengantre.
+_http = requests.Session()
+_http.mount("http://", HTTPAdapter(pool_connections=32, pool_maxsize=WEBHOOK_PER_HOST_LIMIT))
+_http.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=WEBHOOK_PER_HOST_LIMIT))
+_delivery_pool = ThreadPoolExecutor(max_workers=WEBHOOK_MAX_CONCURRENCY, thread_name_prefix="webhook")
+_host_lanes = {}
+_host_lanes_lock = threading.Lock()
+
+def _host_submit(url: str, fn, *args) -> Future:
+    """Jalankan fn(*args) di _delivery_pool dengan maks WEBHOOK_PER_HOST_LIMIT tugas aktif per host;
+    kelebihannya menunggu di antrean host, bukan di worker pool."""
+    host = urlsplit(url or "").netloc.lower()
+    fut = Future()
+    with _host_lanes_lock:
+        lane = _host_lanes.setdefault(host, {"active": 0, "pending": deque()})
+        if lane["active"] >= WEBHOOK_PER_HOST_LIMIT:
+            lane["pending"].append((fut, fn, args))
+            return fut
+        lane["active"] += 1
+    _delivery_pool.submit(_host_run, host, fut, fn, args)
+    return fut
+
+def _host_run(host: str, fut: Future, fn, args):
+    if fut.set_running_or_notify_cancel():
+        try:
+            fut.set_result(fn(*args))
+        except BaseException as e:
+            fut.set_exception(e)
+    with _host_lanes_lock:
+        lane = _host_lanes[host]
+        if not lane["pending"]:
+            lane["active"] -= 1
+            if lane["active"] == 0:
+                del _host_lanes[host]
+            return
+        nxt = lane["pending"].popleft()
+    # slot host diteruskan ke tugas berikutnya, tetapi lewat antrean pool agar host lain tetap kebagian
+    _delivery_pool.submit(_host_run, host, *nxt)
+
+def _host_queue_stats() -> dict:
+    with _host_lanes_lock:
+        return {"hosts": len(_host_lanes), "queued": sum(len(l["pending"]) for l in _host_lanes.values())}
+
+# Slot blocking per host untuk jalur direct broadcast, yang berjalan di thread worker sendiri.
+_host_slots = {}
+_host_slots_lock = threading.Lock()
+
+def _host_slot(url: str) -> threading.BoundedSemaphore:
+    host = urlsplit(url or "").netloc.lower()
+    with _host_slots_lock:
+        slot = _host_slots.get(host)
+        if slot is None:
+            slot = _host_slots[host] = threading.BoundedSemaphore(WEBHOOK_PER_HOST_LIMIT)
+        return slot
+
+class _CircuitBreaker:
+    """Circuit breaker per target URL: closed -> open (failure rate >= ambang dalam
+    jendela BREAKER_WINDOW hasil terakhir) -> half-open setelah cool-down (1 probe)."""
+
+    def __init__(self):
+        self.state = "closed"
+        self.results = deque(maxlen=BREAKER_WINDOW)
+        self.opened_at = None
+        self.probing = False
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= BREAKER_COOLDOWN_SECS:
+                self.state = "half_open"
+                self.probing = False
+            if self.state == "half_open" and not self.probing:
+                self.probing = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record(self, ok: bool):
+        with self.lock:
+            if self.state == "half_open":
+                self.probing = False
+                if ok:
+                    self.state = "closed"
+                    self.results.clear()
+                else:
+                    self.state, self.opened_at = "open", time.monotonic()
+                return
+            self.results.append(ok)
+            failures = self.results.count(False)
+            if (len(self.results) >= BREAKER_MIN_CALLS
+                    and failures / len(self.results) >= BREAKER_FAILURE_RATE):
+                self.state, self.opened_at = "open", time.monotonic()
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                "state": self.state,
+                "window_calls": len(self.results),
+                "window_failures": self.results.count(False),
+                "open_for_secs": round(time.monotonic() - self.opened_at, 1) if self.state != "closed" and self.opened_at else None,
+                "rejected": self.rejected,
+            }
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+CIRCUIT_OPEN = "circuit open"
+
+def _breaker(url: str) -> _CircuitBreaker:
+    with _breakers_lock:
+        br = _breakers.get(url)
+        if br is None:
+            br = _breakers[url] = _CircuitBreaker()
+        return br
+
+def _breaker_stats() -> dict:
+    with _breakers_lock:
+        items = list(_breakers.items())
+    return {url: br.snapshot() for url, br in items}
+
+def _dispatch_one(url: str, secret: str, event, mac=None):
+    # `event` boleh list (subscriber mode batch): dikirim sebagai satu array JSON bertanda tangan
     body = json.dumps(event, ensure_ascii=False).encode("utf-8")
-    sig  = _hmac_signature(secret or "", body)
+    sig  = _hmac_signature(secret or "", body, mac=mac)
     headers = {
         "Content-Type": "application/json",
         "User-Agent": "distributor-webhook/1.0",
-        "X-Event-Type": event["type"],
-        "X-Event-Id": event["id"],
         "X-Signature": sig,
     }
+    if isinstance(event, list):
+        headers["X-Event-Type"] = event[0]["type"]
+        # id event ada di body; header cukup id batch (deterministik) agar tidak melewati batas header proxy
+        headers["X-Batch-Id"] = "batch_" + hashlib.sha1(",".join(e["id"] for e in event).encode("utf-8")).hexdigest()[:16]
+        headers["X-Batch-Size"] = str(len(event))
+    else:
+        headers["X-Event-Type"] = event["type"]
+        headers["X-Event-Id"] = event["id"]
+    br = _breaker(url)
+    if not br.allow():
+        return False, CIRCUIT_OPEN
     try:
-        r = requests.post(url, data=body, headers=headers, timeout=POST_TIMEOUT_SECS)
+        r = _http.post(url, data=body, headers=headers, timeout=POST_TIMEOUT_SECS)
         ok = (200 <= r.status_code < 300)
+        br.record(ok)
         return ok, f"{r.status_code} {r.text[:200]}"
     except Exception as e:
+        br.record(False)
         return False, str(e)
 
-def _enqueue_dlq(sub_id: str, url: str, event: dict, last_err: str):
+class _EventBatcher:
+    """Buffer event untuk satu subscriber mode batch. Dikirim sebagai satu POST begitu
+    terkumpul max_events, atau max_wait_ms setelah event pertama masuk buffer."""
+
+    def __init__(self, url: str, secret: str, mac, max_events: int, max_wait_ms: int):
+        self.url, self.secret, self.mac = url, secret, mac
+        self.max_events = max_events
+        self.max_wait = max_wait_ms / 1000.0
+        self.buf = []
+        self.gen = 0
+        self.lock = threading.Lock()
+
+    def submit(self, event: dict) -> Future:
+        fut = Future()
+        with self.lock:
+            self.buf.append((event, fut))
+            if len(self.buf) >= self.max_events:
+                self._flush_locked()
+            elif len(self.buf) == 1:
+                _batch_schedule(time.monotonic() + self.max_wait, self, self.gen)
+        return fut
+
+    def flush(self, gen=None):
+        with self.lock:
+            if gen is None or gen == self.gen:
+                self._flush_locked()
+
+    def _flush_locked(self):
+        if not self.buf:
+            return
+        items, self.buf = self.buf, []
+        self.gen += 1
+        _host_submit(self.url, self._send, items)
+
+    def _send(self, items):
+        try:
+            res = _dispatch_one(self.url, self.secret, [e for e, _ in items], self.mac)
+        except Exception as e:
+            res = (False, str(e))
+        _batch_state["batches"] += 1
+        _batch_state["events"] += len(items)
+        for _, fut in items:
+            fut.set_result(res)
+
+# Satu thread timer untuk semua batcher (heap deadline), bukan satu Timer per batch.
+_batchers = {}
+_batchers_lock = threading.Lock()
+_batch_timers = []
+_batch_cond = threading.Condition()
+_batch_state = {"thread": None, "seq": 0, "batches": 0, "events": 0}
+
+def _batch_timer_loop():
+    while True:
+        with _batch_cond:
+            while not _batch_timers:
+                _batch_cond.wait()
+            deadline, _, batcher, gen = _batch_timers[0]
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                _batch_cond.wait(delay)
+                continue
+            heapq.heappop(_batch_timers)
+        batcher.flush(gen)
+
+def _batch_schedule(deadline: float, batcher: "_EventBatcher", gen: int):
+    with _batch_cond:
+        if _batch_state["thread"] is None:
+            th = threading.Thread(target=_batch_timer_loop, name="webhook-batch-timer", daemon=True)
+            _batch_state["thread"] = th
+            th.start()
+        _batch_state["seq"] += 1
+        heapq.heappush(_batch_timers, (deadline, _batch_state["seq"], batcher, gen))
+        _batch_cond.notify()
+
+def _batcher_for(sub: dict, url: str) -> _EventBatcher:
+    conf = (url, sub.get("secret", ""), int(sub["batch_max_events"]), int(sub.get("batch_max_wait_ms") or 1000))
+    with _batchers_lock:
+        cur = _batchers.get(sub["id"])
+        if cur is None or cur[0] != conf:
+            cur = _batchers[sub["id"]] = (conf, _EventBatcher(conf[0], conf[1], sub["mac"], conf[2], conf[3]))
+        return cur[1]
+
+def _submit_delivery(sub: dict, url: str, event: dict) -> Future:
+    """Kirim satu event ke satu subscriber di pool; hasil Future -> (ok, info)."""
+    if sub.get("batch_max_events"):
+        return _batcher_for(sub, url).submit(event)
+    return _host_submit(url, _dispatch_one, url, sub.get("secret", ""), event, sub["mac"])
+
+def _enqueue_dlq(sub_id: str, url: str, event: dict, last_err: str, channel: str = "webhook"):
     db.collection(DLQ_COL).add({
         "subscriber_id": sub_id,
         "target_url": url,
+        "channel": channel,
         "event": event,
         "last_error": last_err,
         "created_at": now_iso(),
@@ -232,8 +869,9 @@ def _build_status_event(doc_after: dict, old_status: str, new_status: str) -> di
     else:
         status_now = "ON_DELIVERY"
 
+    c = _canonical(doc_after)
     items = []
-    raw_items = doc_after.get("barang_dipesan")
+    raw_items = c["barang_dipesan"]
     if isinstance(raw_items, list) and len(raw_items) > 0:
 
         for it in raw_items:
@@ -244,36 +882,23 @@ def _build_status_event(doc_after: dict, old_status: str, new_status: str) -> di
             })
     else:
 
-        if doc_after.get("nama_barang"):
+        if c["nama_barang"]:
             items.append({
                 "id_barang": None,
-                "nama_barang": str(doc_after.get("nama_barang")).strip(),
-                "kuantitas": int(doc_after.get("kuantitas", 0) or 0),
+                "nama_barang": str(c["nama_barang"]).strip(),
+                "kuantitas": int(c["qty"] or 0),
             })
 
-    total_kuantitas = (
-        doc_after.get("total_kuantitas")
-        or doc_after.get("kuantitas")
-        or sum((it.get("kuantitas") or 0) for it in items)
-        or 0
-    )
-
-    biaya_pengiriman = (
-        doc_after.get("biaya_pengiriman")
-        or doc_after.get("harga_pengiriman")
-        or 0
-    )
-
-    route = {
-        "origin": doc_after.get("asal_pengirim") or doc_after.get("asal_supplier"),
-        "destination": doc_after.get("tujuan") or doc_after.get("tujuan_retail"),
-    }
+    total_kuantitas = c["qty"] or sum((it.get("kuantitas") or 0) for it in items) or 0
+    biaya_pengiriman = c["price"] or 0
+
+    route = {"origin": c["origin"], "destination": c["dest"]}
 
     order_info = {
-        "id_order": doc_after.get("id_order"),
-        "id_retail": doc_after.get("id_retail"),
-        "supplier": doc_after.get("nama_supplier"),
-        "distributor": doc_after.get("nama_distributor") or doc_after.get("distributor_name"),
+        "id_order": c["id_order"],
+        "id_retail": c["id_retail"],
+        "supplier": c["nama_supplier"],
+        "distributor": c["distributor_name"],
     }
 
     return {
@@ -282,8 +907,8 @@ def _build_status_event(doc_after: dict, old_status: str, new_status: str) -> di
         "created_at": now_iso(),
         "version": 1,
         "data": {
-            "no_resi": doc_after.get("no_resi"),
-            "doc_id": doc_after.get("doc_id"),
+            "no_resi": c["no_resi"],
+            "doc_id": c["doc_id"],
             "old_status": old_status,
             "new_status": new_status,
             "status_now": status_now,
@@ -296,23 +921,221 @@ def _build_status_event(doc_after: dict, old_status: str, new_status: str) -> di
         }
     }
 
-def _notify_status_change(doc_after: dict, old_status: str, new_status: str):
-    subs = _load_active_subscribers(EVENT_STATUS_UPDATED)
-    if not subs:
+def _outbox_entry(event: dict):
+    """Event status untuk webhook_outbox; ditulis di batch yang sama dengan update status."""
+    return db.collection(OUTBOX_COL).document(event["id"]), {
+        "event": event,
+        "event_type": event["type"],
+        "created_at": now_iso(),
+        "next_attempt_at": now_iso(),
+        "rounds": 0,
+        "targets": None,
+    }
+
+def _status_transition(event: dict) -> dict:
+    d = event.get("data") or {}
+    return {"old_status": d.get("old_status"), "new_status": d.get("new_status"),
+            "updated_at": d.get("updated_at") or event.get("created_at")}
+
+def _coalesce_events(prev: dict, new: dict) -> dict:
+    """Gabungkan dua event status untuk resi yang sama: isi terbaru, old_status dari
+    event pertama, dan daftar transisi di antaranya."""
+    transitions = (prev.get("data") or {}).get("transitions") or [_status_transition(prev)]
+    data = dict(new.get("data") or {},
+                old_status=(prev.get("data") or {}).get("old_status"),
+                transitions=transitions + [_status_transition(new)])
+    return dict(new, data=data)
+
+def _coalesce_ref(no_resi: str):
+    return db.collection(OUTBOX_COL).document(f"coalesce_{no_resi}")
+
+def _outbox_coalesce(event: dict, txn=None, snap=None):
+    """Op outbox (format _apply_ops) untuk event. Bila COALESCE_WINDOW_SECS aktif, event untuk
+    no_resi yang sama digabung ke satu dokumen selama belum diambil dispatcher.
+    Di luar transaksi (`snap` = dokumen coalesce yang sudah dibaca lewat get_all) tulisannya
+    diberi precondition, jadi gagal bila dokumen itu berubah sejak dibaca.
+    Selama dokumen itu sedang dikirim/menunggu retry, event baru ditahan di `next_event` (digabung
+    bila lebih dari satu) dan baru dikirim setelah event sebelumnya selesai, jadi urutan per
+    resi terjaga. Return (op, digabung); penghitung `coalesced` dinaikkan pemanggil setelah commit."""
+    no_resi = (event.get("data") or {}).get("no_resi")
+    if COALESCE_WINDOW_SECS <= 0 or not no_resi:
+        return ("set", *_outbox_entry(event)), False
+    ref = _coalesce_ref(no_resi)
+    if snap is None:
+        snap = ref.get(transaction=txn)
+    prev = snap.to_dict() if snap.exists else None
+    if prev:
+        if prev.get("coalescing"):
+            data, merged = dict(prev, event=_coalesce_events(prev["event"], event)), True
+        else:
+            # entri sebelumnya sedang dikirim/di-retry: tahan event ini sampai entri itu selesai
+            held = prev.get("next_event")
+            data, merged = dict(prev, next_event=_coalesce_events(held, event) if held else event), bool(held)
+        if txn is not None:
+            return ("set", ref, data), merged
+        return ("update", ref, data, db.write_option(last_update_time=snap.update_time)), merged
+    due = (datetime.now(timezone.utc) + timedelta(seconds=COALESCE_WINDOW_SECS)).isoformat()
+    _, data = _outbox_entry(event)
+    return ("set" if txn is not None else "create", ref, dict(data, next_attempt_at=due, coalescing=True)), False
+
+# Dispatcher outbox: thread latar yang mengambil event jatuh tempo dari webhook_outbox
+# dan mengirimnya lewat pool worker terbatas. Klaim = menggeser next_attempt_at sejauh
+# OUTBOX_LEASE_SECS di dalam transaksi, jadi event milik proses yang mati otomatis diambil lagi.
+_outbox_wakeup = threading.Event()
+_outbox_stop = threading.Event()
+_outbox_state = {"thread": None, "executor": None, "delivered": 0, "retried": 0, "dead_lettered": 0,
+                 "coalesced": 0, "errors": 0}
+
+@firestore.transactional
+def _outbox_claim(txn, ref):
+    snap = ref.get(transaction=txn)
+    if not snap.exists:
+        return None
+    data = snap.to_dict()
+    if (data.get("next_attempt_at") or "") > now_iso():
+        return None
+    lease = (datetime.now(timezone.utc) + timedelta(seconds=OUTBOX_LEASE_SECS)).isoformat()
+    txn.update(ref, {"next_attempt_at": lease, "coalescing": False})
+    return data
+
+@firestore.transactional
+def _outbox_finish(txn, ref, event_id: str, update) -> bool:
+    """Selesaikan dokumen coalesce. Event yang ditahan di `next_event` selama pengiriman
+    dinaikkan jadi event berikutnya begitu event ini tidak lagi perlu di-retry.
+    Return True bila ada event yang dinaikkan."""
+    snap = ref.get(transaction=txn)
+    if not snap.exists:
+        return False
+    data = snap.to_dict()
+    if data["event"]["id"] != event_id:
+        return False
+    if update is not None:
+        txn.update(ref, update)
+        return False
+    held = data.get("next_event")
+    if held is None:
+        txn.delete(ref)
+        return False
+    _, entry = _outbox_entry(held)
+    txn.set(ref, dict(entry, coalescing=True))
+    return True
+
+def _outbox_send(ref):
+    """Tahap 1: klaim event dan serahkan ke pool/batcher tanpa menunggu hasil."""
+    data = _outbox_claim(db.transaction(), ref)
+    if data is None:
+        return None
+    event = data["event"]
+    subs = {s["id"]: s for s in _load_active_subscribers(data.get("event_type") or event["type"])}
+
+    targets = data.get("targets")
+    if targets is None:
+        targets = {sid: {"url": s.get("url"), "attempts": 0, "last_error": ""} for sid, s in subs.items()}
+
+    # subscriber yang sudah nonaktif tidak dikirimi lagi
+    futures = {sid: _submit_delivery(subs[sid], t["url"], event)
+               for sid, t in targets.items() if sid in subs}
+    return ref, data, targets, futures
+
+def _outbox_settle(ref, data, targets, futures):
+    """Tahap 2: tunggu hasil pengiriman, lalu hapus event / jadwalkan retry / DLQ."""
+    event = data["event"]
+    results = {sid: f.result() for sid, f in futures.items()}
+    pending = {}
+    for sid, (ok, info) in results.items():
+        t = targets[sid]
+        if ok:
+            _outbox_state["delivered"] += 1
+            continue
+        t = dict(t, attempts=t["attempts"] + 1, last_error=info)
+        if t["attempts"] >= MAX_RETRIES or info == CIRCUIT_OPEN:
+            _enqueue_dlq(sub_id=sid, url=t["url"], event=event, last_err=info)
+            _outbox_state["dead_lettered"] += 1
+        else:
+            pending[sid] = t
+            _outbox_state["retried"] += 1
+
+    update = None
+    if pending:
+        rounds = int(data.get("rounds", 0)) + 1
+        delay = (BACKOFF_BASE * (2 ** (rounds - 1))) + (0.05 * rounds)
+        update = {
+            "targets": pending,
+            "rounds": rounds,
+            "next_attempt_at": (datetime.now(timezone.utc) + timedelta(seconds=delay)).isoformat(),
+        }
+    if ref.id.startswith("coalesce_"):
+        if _outbox_finish(db.transaction(), ref, event["id"], update):
+            _outbox_wakeup.set()
+    elif update is None:
+        ref.delete()
+    else:
+        ref.update(update)
+
+def _outbox_collect(futures) -> list:
+    out = []
+    for f in futures:
+        try:
+            out.append(f.result())
+        except Exception as e:
+            _outbox_state["errors"] += 1
+            app.logger.warning(f"[Outbox] gagal memproses event: {e}")
+    return out
+
+def _outbox_run():
+    executor = _outbox_state["executor"]
+    while not _outbox_stop.is_set():
+        try:
+            due = (db.collection(OUTBOX_COL)
+                   .where("next_attempt_at", "<=", now_iso())
+                   .order_by("next_attempt_at")
+                   .limit(OUTBOX_PAGE_SIZE)
+                   .get())
+            # semua event satu halaman dikirim dulu, baru ditunggu, supaya batcher
+            # subscriber mode batch bisa menggabungkan event-event tersebut
+            sent = _outbox_collect([executor.submit(_outbox_send, s.reference) for s in due])
+            _outbox_collect([executor.submit(_outbox_settle, *job) for job in sent if job is not None])
+            if len(due) == OUTBOX_PAGE_SIZE:
+                continue  # masih ada antrean, langsung ambil lagi
+        except Exception as e:
+            _outbox_state["errors"] += 1
+            app.logger.warning(f"[Outbox] polling gagal: {e}")
+        _outbox_wakeup.wait(OUTBOX_POLL_SECS)
+        _outbox_wakeup.clear()
+
+def _outbox_start():
+    if not OUTBOX_DISPATCHER_ENABLED or _outbox_state["thread"] is not None:
         return
-    event = _build_status_event(doc_after, old_status, new_status)
-    for sub in subs:
-        url = sub.get("url"); secret = sub.get("secret","")
-        success = False; last_err = ""
-        for i in range(MAX_RETRIES):
-            ok, info = _dispatch_one(url, secret, event)
-            if ok:
-                success = True
-                break
-            last_err = info
-            time.sleep((BACKOFF_BASE * (2 ** i)) + (0.05 * i))
-        if not success:
-            _enqueue_dlq(sub_id=sub["id"], url=url, event=event, last_err=last_err)
+    _outbox_state["executor"] = ThreadPoolExecutor(max_workers=OUTBOX_WORKERS, thread_name_prefix="outbox")
+    th = threading.Thread(target=_outbox_run, name="outbox-dispatcher", daemon=True)
+    _outbox_state["thread"] = th
+    th.start()
+    atexit.register(_outbox_shutdown)
+
+def _outbox_shutdown():
+    _outbox_stop.set()
+    _outbox_wakeup.set()
+    th = _outbox_state["thread"]
+    if th is not None:
+        th.join(timeout=POST_TIMEOUT_SECS + 1)
+    if _outbox_state["executor"] is not None:
+        _outbox_state["executor"].shutdown(wait=True)
+
+def _outbox_stats() -> dict:
+    return {
+        "enabled": OUTBOX_DISPATCHER_ENABLED,
+        "running": bool(_outbox_state["thread"] and _outbox_state["thread"].is_alive()),
+        "workers": OUTBOX_WORKERS,
+        "delivered": _outbox_state["delivered"],
+        "retried": _outbox_state["retried"],
+        "dead_lettered": _outbox_state["dead_lettered"],
+        "coalesced": _outbox_state["coalesced"],
+        "coalesce_window_secs": COALESCE_WINDOW_SECS,
+        "batches_sent": _batch_state["batches"],
+        "batched_events": _batch_state["events"],
+        "host_queues": _host_queue_stats(),
+        "errors": _outbox_state["errors"],
+    }
 
 @app.route("/api/biaya", methods=["POST"])
 def quote_price():
@@ -333,10 +1156,17 @@ def quote_price():
     if not info or info.get("price_base") is None:
         return jsonify({"status": "error", "message": "Rute tidak terdaftar."}), 404
 
+    total_price = calc_price(int(info["price_base"]), kuantitas,
+                             float(info.get("per_kg_factor", 0.7)), int(info.get("included_kg", 1)))
+    payload = _build_quote(asal, tujuan, kuantitas, info, total_price)
+    db.collection(COL_QUOTES).document(payload["quote_id"]).set(payload)
+    resp = dict(payload); resp["status"] = "success"
+    return jsonify(resp), 200
+
+def _build_quote(asal: str, tujuan: str, kuantitas: int, info: dict, total_price: int) -> dict:
     price_base    = int(info["price_base"])
     per_kg_factor = float(info.get("per_kg_factor", 0.7))
     included_kg   = int(info.get("included_kg", 1))
-    total_price   = calc_price(price_base, kuantitas, per_kg_factor, included_kg)
 
     eta_days_val     = int(info.get("eta_days", 1))
     distributor_id   = int(info.get("distributor_id", 2))
@@ -345,7 +1175,7 @@ def quote_price():
     eta_date = add_days_ymd(eta_days_val)
 
     quote_id = f"Q-{secrets.token_hex(6)}".upper()
-    payload = {
+    return {
         "quote_id": quote_id,
         "asal_pengirim": asal,
         "tujuan": tujuan,
@@ -365,30 +1195,342 @@ def quote_price():
         "generated_at": now_iso(),
         "valid_until": today_ymd(),
     }
-    db.collection(COL_QUOTES).document(quote_id).set(payload)
-    resp = dict(payload); resp["status"] = "success"
-    return jsonify(resp), 200
 
-@app.route("/api/pengiriman", methods=["POST"])
-def api_pengiriman():
-    data = request.get_json(force=True) or {}
+@app.route("/api/biaya/batch", methods=["POST"])
+def quote_price_batch():
+    data = request.get_json(force=True)
+    entries = data.get("items") if isinstance(data, dict) else data
+    if not isinstance(entries, list) or len(entries) == 0:
+        return jsonify({"status": "error", "message": "Body harus list (atau {items: [...]}) dan tidak kosong."}), 400
+    if len(entries) > MAX_BATCH_QUOTES:
+        return jsonify({"status": "error", "message": f"Maksimal {MAX_BATCH_QUOTES} entri per batch."}), 400
+
+    results = [None] * len(entries)
+    valid = []  # (index, asal, tujuan, kuantitas, info)
+    routes = {}
+    for i, e in enumerate(entries):
+        if not isinstance(e, dict):
+            results[i] = {"index": i, "status": "error", "code": 400, "message": "Entri harus object."}
+            continue
+        asal = (e.get("asal_pengirim") or "").strip()
+        tujuan = (e.get("tujuan") or "").strip()
+        if "kuantitas" not in e:
+            results[i] = {"index": i, "status": "error", "code": 400, "message": "kuantitas wajib."}
+            continue
+        try:
+            kuantitas = int(e.get("kuantitas"))
+        except Exception:
+            results[i] = {"index": i, "status": "error", "code": 400, "message": "kuantitas harus angka."}
+            continue
+        if not asal or not tujuan:
+            results[i] = {"index": i, "status": "error", "code": 400, "message": "asal_pengirim dan tujuan wajib."}
+            continue
+
+        key = _route_key(asal, tujuan)
+        if key not in routes:
+            routes[key] = route_info(asal, tujuan)
+        info = routes[key]
+        if not info or info.get("price_base") is None:
+            results[i] = {"index": i, "status": "error", "code": 404, "message": "Rute tidak terdaftar."}
+            continue
+        valid.append((i, asal, tujuan, kuantitas, info))
+
+    if valid:
+        prices = calc_price_many(
+            [int(v[4]["price_base"]) for v in valid],
+            [v[3] for v in valid],
+            [float(v[4].get("per_kg_factor", 0.7)) for v in valid],
+            [int(v[4].get("included_kg", 1)) for v in valid],
+        )
+        batch = db.batch()
+        for (i, asal, tujuan, kuantitas, info), price in zip(valid, prices.tolist()):
+            payload = _build_quote(asal, tujuan, kuantitas, info, int(price))
+            batch.set(db.collection(COL_QUOTES).document(payload["quote_id"]), payload)
+            results[i] = dict(payload, index=i, status="success")
+        batch.commit()
+
+    return jsonify({
+        "status": "success",
+        "count": len(entries),
+        "ok": len(valid),
+        "failed": len(entries) - len(valid),
+        "results": results,
+    }), 200
+
+def _apply_ops(writer, ops):
+    """Terapkan op (op, ref, data[, option]) ke WriteBatch atau Transaction. `option` (precondition
+    dari db.write_option) hanya berlaku untuk update/delete."""
+    for op, ref, data, *opt in ops:
+        option = opt[0] if opt else None
+        if op == "set":
+            writer.set(ref, data)
+        elif op == "create":
+            writer.create(ref, data)
+        elif op == "merge":
+            writer.set(ref, data, merge=True)
+        elif op == "update":
+            writer.update(ref, data, option=option)
+        else:
+            writer.delete(ref, option=option)
+
+def _commit_batched(groups):
+    """Commit grup op (list of (op, ref, data)) lewat WriteBatch, maks FIRESTORE_BATCH_LIMIT op per commit.
+    Op satu grup tidak pernah dipecah ke dua batch. Bila commit gabungan gagal (mis. precondition
+    satu grup), tiap grup di chunk itu di-commit ulang sendiri-sendiri supaya grup lain tidak ikut gagal.
+    Return list error (None jika sukses) per grup."""
+    errors = [None] * len(groups)
+    chunk, chunk_idx = [], []
+
+    def _commit(ops):
+        batch = db.batch()
+        _apply_ops(batch, ops)
+        batch.commit()
+
+    def _flush():
+        if not chunk:
+            return
+        try:
+            _commit(chunk)
+        except Exception as e:
+            if len(chunk_idx) == 1:
+                errors[chunk_idx[0]] = str(e)
+            else:
+                for gi in chunk_idx:
+                    try:
+                        _commit(groups[gi])
+                    except Exception as ge:
+                        errors[gi] = str(ge)
+        chunk.clear(); chunk_idx.clear()
+
+    for gi, ops in enumerate(groups):
+        if len(chunk) + len(ops) > FIRESTORE_BATCH_LIMIT:
+            _flush()
+        chunk.extend(ops); chunk_idx.append(gi)
+    _flush()
+    return errors
+
+def _resi_index_entry(no_resi: str, collection: str, doc_id: str):
+    return (db.collection(COL_RESI_INDEX).document(no_resi),
+            {"collection": collection, "doc_id": doc_id, "updated_at": now_iso()})
+
+def _new_shipment_ops(doc: dict):
+    # resi_index ditulis dengan create(): resi yang kebetulan sudah dipakai gagal, tidak menimpa pointer lama
+    return [("set", db.collection(COL_SHIPMENTS).document(doc["doc_id"]), doc),
+            ("create", *_resi_index_entry(doc["no_resi"], COL_SHIPMENTS, doc["doc_id"]))]
+
+def _insert_shipment(doc: dict, extra_ops=()):
+    """Commit shipment baru + resi_index (+ extra_ops) dalam satu batch. Bila no_resi sudah ada
+    di resi_index, resi dibuat ulang dan dicoba lagi (maks RESI_CREATE_ATTEMPTS)."""
+    for attempt in range(RESI_CREATE_ATTEMPTS):
+        batch = db.batch()
+        _apply_ops(batch, _new_shipment_ops(doc) + list(extra_ops))
+        try:
+            batch.commit()
+            return doc
+        except AlreadyExists:
+            if attempt == RESI_CREATE_ATTEMPTS - 1:
+                raise
+            app.logger.warning(f"[ResiIndex] resi {doc['no_resi']} bentrok, dibuat ulang")
+            doc["no_resi"] = gen_resi()
+
+def _reserve_resis(docs):
+    """Sebelum bulk insert: ganti no_resi yang duplikat di dalam batch atau sudah ada di resi_index."""
+    pending = list(docs)
+    taken = set()
+    for _ in range(RESI_CREATE_ATTEMPTS):
+        if not pending:
+            return
+        refs = [db.collection(COL_RESI_INDEX).document(d["no_resi"]) for d in pending]
+        taken |= {s.id for s in db.get_all(refs) if s.exists}
+        clash = []
+        for d in pending:
+            if d["no_resi"] in taken:
+                d["no_resi"] = gen_resi()
+                clash.append(d)
+            else:
+                taken.add(d["no_resi"])
+        pending = clash
+
+def _find_shipment_by_resi(no_resi: str):
+    """Cari shipment via resi_index/{no_resi}. Return (collection, doc_id, dict) atau None.
+    Resi lama yang belum ter-backfill dicari dengan query lalu index-nya diperbaiki."""
+    found = _view_by_resi(no_resi)
+    if found:
+        return found
+    idx = db.collection(COL_RESI_INDEX).document(no_resi).get()
+    if idx.exists:
+        ptr = idx.to_dict() or {}
+        if ptr.get("collection") == COL_COLD:
+            return COL_COLD, ptr.get("doc_id"), ptr.get("doc") or {}
+        snap = db.collection(ptr.get("collection") or COL_SHIPMENTS).document(ptr.get("doc_id") or "").get()
+        if snap.exists:
+            return ptr["collection"], snap.id, snap.to_dict()
+
+    for col in (COL_SHIPMENTS, COL_HISTORY):
+        found = db.collection(col).where("no_resi", "==", no_resi).limit(1).get()
+        if found:
+            ref, data = _resi_index_entry(no_resi, col, found[0].id)
+            try:
+                ref.set(data)
+            except Exception as e:
+                app.logger.warning(f"[ResiIndex] gagal memperbaiki index {no_resi}: {e}")
+            return col, found[0].id, found[0].to_dict()
+    return None
+
+# Field yang dibutuhkan _status_payload; disalin ke resi_index saat dokumen dipindah ke arsip dingin.
+_COLD_INDEX_FIELDS = (
+    "schema", "no_resi", "status", "asal_pengirim", "asal_supplier", "tujuan", "tujuan_retail", "currency",
+    "harga_pengiriman", "biaya_pengiriman", "harga_dasar", "per_kg_factor", "included_kg",
+    "distributor_id", "distributor_name", "nama_distributor", "eta_days", "eta_text",
+    "eta_delivery_date", "tanggal_pembelian", "updated_at",
+)
+
+def archive_completed(limit: int = None) -> dict:
+    """Pindahkan pesanan selesai yang masih tertinggal di tb_pengiriman ke tb_histori, per batch.
+    Delete memakai precondition exists=True: bila proses lain sudah memindahkan dokumen yang sama,
+    grupnya gagal dan tidak ikut dihitung."""
+    exists = db.write_option(exists=True)
+    report = {"moved": 0, "failed": 0}
+    while limit is None or report["moved"] < limit:
+        size = ARCHIVE_PAGE_SIZE if limit is None else min(ARCHIVE_PAGE_SIZE, limit - report["moved"])
+        page = db.collection(COL_SHIPMENTS).where("status", "==", STATUS_LIST[-1]).limit(size).get()
+        if not page:
+            break
+        groups = []
+        for s in page:
+            d = s.to_dict() or {}
+            ops = [("set", db.collection(COL_HISTORY).document(s.id), d), ("delete", s.reference, None, exists)]
+            if d.get("no_resi"):
+                ops.append(("set", *_resi_index_entry(d["no_resi"], COL_HISTORY, s.id)))
+            groups.append(ops)
+        errors = _commit_batched(groups)
+        for s, err in zip(page, errors):
+            if err:
+                report["failed"] += 1
+            else:
+                report["moved"] += 1
+                _view_write_through(s.id, s.to_dict() or {})
+                _status_cache_invalidate(s.get("no_resi"))
+        if report["failed"] or len(page) < size:
+            break
+    return report
+
+def compact_history(older_than_days: int = None, out_dir: str = None) -> dict:
+    """Pindahkan tb_histori yang updated_at-nya lebih tua dari `older_than_days` ke file
+    {out_dir}/tb_histori-YYYY-MM-<run_id>.ndjson.gz (per bulan selesai, satu file per run),
+    tambahkan rangkumannya ke tb_histori_summary/{YYYY-MM}, dan sisakan pointer ramping di
+    resi_index untuk /status.
+    Delete memakai precondition exists=True, jadi bila job jalan bersamaan di beberapa proses
+    setiap dokumen hanya dimenangkan satu run. Baris masuk ke file part hanya setelah delete-nya
+    ter-commit; sebelum commit halaman ditulis ke <part>.pending (dihapus sesudahnya) supaya
+    data tidak hilang bila proses mati di tengah jalan."""
+    older_than_days = HISTORY_COMPACT_AFTER_DAYS if older_than_days is None else older_than_days
+    out_dir = out_dir or ARCHIVE_DIR
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=older_than_days)).isoformat()
+    os.makedirs(out_dir, exist_ok=True)
+    run_id = f"{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S')}-{secrets.token_hex(3)}"
+    exists = db.write_option(exists=True)
+    report = {"compacted": 0, "failed": 0, "months": {}}
+    while True:
+        page = (db.collection(COL_HISTORY)
+                .where("updated_at", "<", cutoff)
+                .order_by("updated_at")
+                .limit(ARCHIVE_PAGE_SIZE)
+                .get())
+        if not page:
+            break
+        by_month = {}
+        for s in page:
+            by_month.setdefault(str(s.get("updated_at"))[:7], []).append(s)
+        failed = 0
+        for month, snaps in by_month.items():
+            path = os.path.join(out_dir, f"{COL_HISTORY}-{month}-{run_id}.ndjson.gz")
+            docs = [dict(s.to_dict() or {}, doc_id=s.id) for s in snaps]
+            lines = [json.dumps(d, ensure_ascii=False, default=str) + "\n" for d in docs]
+            with gzip.open(path + ".pending", "wt", encoding="utf-8") as f:
+                f.writelines(lines)
+            groups = []
+            for s, d in zip(snaps, docs):
+                ops = [("delete", s.reference, None, exists)]
+                if d.get("no_resi"):
+                    ref, data = _resi_index_entry(d["no_resi"], COL_COLD, s.id)
+                    ops.append(("set", ref, dict(data, file=os.path.basename(path),
+                                                 doc={k: d[k] for k in _COLD_INDEX_FIELDS if d.get(k) is not None})))
+                groups.append(ops)
+            errors = _commit_batched(groups)
+            with gzip.open(path, "at", encoding="utf-8") as f:
+                f.writelines(line for line, err in zip(lines, errors) if not err)
+            os.remove(path + ".pending")
+            summary = {"count": 0, "revenue": 0, "rollup": {}}
+            for d, err in zip(docs, errors):
+                if err:
+                    failed += 1
+                    continue
+                summary["count"] += 1
+                summary["revenue"] += float(d.get("harga_pengiriman") or d.get("biaya_pengiriman") or 0)
+                _deep_add(summary["rollup"], _analytics_created_delta(d))
+                day = _purchase_day(d)
+                if day:
+                    _deep_add(summary["rollup"], {"completed_by_month": {day[:7]: 1}})
+            if summary["count"]:
+                db.collection(COL_HISTORY_SUMMARY).document(month).set(
+                    dict(_to_increments(summary), files=firestore.ArrayUnion([os.path.basename(path)]),
+                         updated_at=now_iso()), merge=True)
+            report["compacted"] += summary["count"]
+            report["months"][month] = report["months"].get(month, 0) + summary["count"]
+        report["failed"] += failed
+        if failed or len(page) < ARCHIVE_PAGE_SIZE:
+            break
+    return report
+
+_archive_stop = threading.Event()
+_archive_state = {"thread": None, "last_run": None, "last_report": None, "errors": 0}
+
+def _archive_run():
+    while not _archive_stop.wait(ARCHIVE_JOB_INTERVAL_SECS):
+        try:
+            _archive_state["last_report"] = {"archive": archive_completed(), "compact": compact_history()}
+            _archive_state["last_run"] = now_iso()
+        except Exception as e:
+            _archive_state["errors"] += 1
+            app.logger.warning(f"[Archive] job gagal: {e}")
+
+def _archive_start():
+    if ARCHIVE_JOB_INTERVAL_SECS <= 0 or _archive_state["thread"] is not None:
+        return
+    th = threading.Thread(target=_archive_run, name="archive-job", daemon=True)
+    _archive_state["thread"] = th
+    th.start()
+    atexit.register(_archive_stop.set)
+
+def _archive_stats() -> dict:
+    return {
+        "enabled": ARCHIVE_JOB_INTERVAL_SECS > 0,
+        "interval_secs": ARCHIVE_JOB_INTERVAL_SECS,
+        "compact_after_days": HISTORY_COMPACT_AFTER_DAYS,
+        "last_run": _archive_state["last_run"],
+        "last_report": _archive_state["last_report"],
+        "errors": _archive_state["errors"],
+    }
+
+def _build_pengiriman_doc(data: dict, routes: dict = None):
+    """Validasi payload /api/pengiriman dan susun dokumen tb_pengiriman.
+    Return (doc, None) atau (None, (message, http_code)). `routes` = memo route_info per request."""
+    if not isinstance(data, dict):
+        return None, ("Payload harus object.", 400)
 
-    missing = []
-    for fld in ["id_order", "id_retail", "nama_supplier", "asal_supplier", "tujuan_retail", "barang_dipesan"]:
-        if fld not in data or data[fld] in (None, "", []):
-            pass
     missing = []
     for fld in ["id_order", "id_retail", "nama_supplier", "asal_supplier", "tujuan_retail", "barang_dipesan"]:
         if fld not in data or data[fld] in (None, "", []):
             missing.append(fld)
     if missing:
-        return jsonify({"status": "error", "message": f"Field wajib hilang: {', '.join(missing)}"}), 400
+        return None, (f"Field wajib hilang: {', '.join(missing)}", 400)
 
     try:
         id_order = int(data["id_order"])
         id_retail = int(data["id_retail"])
     except Exception:
-        return jsonify({"status": "error", "message": "id_order dan id_retail harus angka."}), 400
+        return None, ("id_order dan id_retail harus angka.", 400)
 
     nama_supplier = str(data["nama_supplier"]).strip()
     nama_distributor_in = str(data.get("nama_distributor", "")).strip()
@@ -397,7 +1539,7 @@ def api_pengiriman():
 
     items_in = data.get("barang_dipesan") or []
     if not isinstance(items_in, list) or len(items_in) == 0:
-        return jsonify({"status": "error", "message": "barang_dipesan harus list dan tidak kosong."}), 400
+        return None, ("barang_dipesan harus list dan tidak kosong.", 400)
 
     items = []
     total_kuantitas = 0
@@ -407,15 +1549,21 @@ def api_pengiriman():
             nm  = str(it.get("nama_barang", "")).strip()
             qty = int(it.get("kuantitas", 0))
         except Exception:
-            return jsonify({"status": "error", "message": "kuantitas item harus angka."}), 400
+            return None, ("kuantitas item harus angka.", 400)
         if not iid or not nm or qty <= 0:
-            return jsonify({"status": "error", "message": "Setiap item wajib id_barang, nama_barang, kuantitas > 0."}), 400
+            return None, ("Setiap item wajib id_barang, nama_barang, kuantitas > 0.", 400)
         total_kuantitas += qty
         items.append({"id_barang": iid, "nama_barang": nm, "kuantitas": qty})
 
-    info = route_info(asal, tujuan)
+    if routes is None:
+        info = route_info(asal, tujuan)
+    else:
+        key = _route_key(asal, tujuan)
+        if key not in routes:
+            routes[key] = route_info(asal, tujuan)
+        info = routes[key]
     if not info or info.get("price_base") is None:
-        return jsonify({"status": "error", "message": "Rute tidak terdaftar."}), 404
+        return None, ("Rute tidak terdaftar.", 404)
 
     price_base    = int(info["price_base"])
     per_kg_factor = float(info.get("per_kg_factor", 0.7))
@@ -432,7 +1580,8 @@ def api_pengiriman():
     no_resi = gen_resi()
     doc_id = f"PG-{secrets.token_hex(5)}".upper()
 
-    doc = {
+    return {
+        "schema": SCHEMA_PENGIRIMAN,
         "doc_id": doc_id,
         "no_resi": no_resi,
         "biaya_pengiriman": total_price,
@@ -443,6 +1592,8 @@ def api_pengiriman():
         "nama_distributor": distributor_name,
         "asal_supplier": asal,
         "tujuan_retail": tujuan,
+        "route_origin": _route_key(asal, tujuan)[0],
+        "route_dest": _route_key(asal, tujuan)[1],
         "barang_dipesan": items,
         "total_kuantitas": total_kuantitas,
         "currency": "IDR",
@@ -456,20 +1607,95 @@ def api_pengiriman():
         "tanggal_pembelian": today_ymd(),
         "created_at": now_iso(),
         "updated_at": now_iso(),
-    }
-    db.collection(COL_SHIPMENTS).document(doc_id).set(doc)
+    }, None
 
-    return jsonify({
+def _pengiriman_response(doc: dict) -> dict:
+    return {
         "status": "success",
-        "id_pengiriman": doc_id,
-        "no_resi": no_resi,
-        "biaya_pengiriman": total_price,
+        "id_pengiriman": doc["doc_id"],
+        "no_resi": doc["no_resi"],
+        "biaya_pengiriman": doc["biaya_pengiriman"],
         "status_pengiriman": doc["status"],
         "currency": "IDR",
-        "eta_days": eta_days_val,
-        "eta_text": eta_txt,
-        "eta_delivery_date": eta_date
-    }), 201
+        "eta_days": doc["eta_days"],
+        "eta_text": doc["eta_text"],
+        "eta_delivery_date": doc["eta_delivery_date"],
+    }
+
+@app.route("/api/pengiriman", methods=["POST"])
+def api_pengiriman():
+    data = request.get_json(force=True) or {}
+
+    doc, err = _build_pengiriman_doc(data)
+    if err:
+        return jsonify({"status": "error", "message": err[0]}), err[1]
+
+    _insert_shipment(doc, [("merge", *_analytics_entry(_analytics_created_delta(doc)))])
+
+    return jsonify(_pengiriman_response(doc)), 201
+
+@app.route("/api/pengiriman/bulk", methods=["POST"])
+def api_pengiriman_bulk():
+    if (request.mimetype or "") in ("application/x-ndjson", "application/jsonl"):
+        entries = []
+        for n, line in enumerate(request.get_data(as_text=True).splitlines(), start=1):
+            if not line.strip():
+                continue
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                return jsonify({"status": "error", "message": f"NDJSON tidak valid di baris {n}."}), 400
+    else:
+        data = request.get_json(force=True)
+        entries = data.get("items") if isinstance(data, dict) else data
+
+    if not isinstance(entries, list) or len(entries) == 0:
+        return jsonify({"status": "error", "message": "Body harus list (atau {items: [...]}/NDJSON) dan tidak kosong."}), 400
+    if len(entries) > MAX_BULK_SHIPMENTS:
+        return jsonify({"status": "error", "message": f"Maksimal {MAX_BULK_SHIPMENTS} entri per request."}), 400
+
+    results = [None] * len(entries)
+    docs, doc_idx = [], []
+    routes = {}
+    for i, data in enumerate(entries):
+        doc, err = _build_pengiriman_doc(data, routes)
+        if err:
+            results[i] = {"index": i, "status": "error", "code": err[1], "message": err[0]}
+            continue
+        docs.append(doc); doc_idx.append(i)
+
+    _reserve_resis(docs)
+    errors = _commit_batched([_new_shipment_ops(doc) for doc in docs])
+    for n, err in enumerate(errors):
+        # batch gagal (mis. resi bentrok karena race): ulangi per dokumen dengan resi baru bila perlu
+        if err:
+            try:
+                _insert_shipment(docs[n])
+                errors[n] = None
+            except Exception as e:
+                errors[n] = str(e)
+    created = 0
+    rollup = {}
+    for i, doc, err in zip(doc_idx, docs, errors):
+        if err:
+            results[i] = {"index": i, "status": "error", "code": 500, "message": f"Gagal menyimpan: {err}"}
+        else:
+            results[i] = dict(_pengiriman_response(doc), index=i, doc_id=doc["doc_id"])
+            _deep_add(rollup, _analytics_created_delta(doc))
+            created += 1
+    if rollup:
+        try:
+            _analytics_apply(rollup)
+        except Exception as e:
+            app.logger.warning(f"[Analytics] gagal update rollup bulk: {e}")
+
+    return jsonify({
+        "status": "success",
+        "count": len(entries),
+        "ok": created,
+        "failed": len(entries) - created,
+        "results": results,
+    }), 200
 
 @app.route("/shipments", methods=["POST"])
 def create_shipment():
@@ -506,6 +1732,7 @@ def create_shipment():
     no_resi = gen_resi()
     doc_id = f"PG-{secrets.token_hex(5)}".upper()
     doc = {
+        "schema": SCHEMA_SHIPMENTS,
         "doc_id": doc_id,
         "no_resi": no_resi,
         "id_pembeli": id_pembeli,
@@ -513,6 +1740,8 @@ def create_shipment():
         "kuantitas": kuantitas,
         "asal_pengirim": asal,
         "tujuan": tujuan,
+        "route_origin": _route_key(asal, tujuan)[0],
+        "route_dest": _route_key(asal, tujuan)[1],
         "currency": "IDR",
         "harga_dasar": price_base,
         "per_kg_factor": per_kg_factor,
@@ -528,7 +1757,8 @@ def create_shipment():
         "created_at": now_iso(),
         "updated_at": now_iso(),
     }
-    db.collection(COL_SHIPMENTS).document(doc_id).set(doc)
+    _insert_shipment(doc, [("merge", *_analytics_entry(_analytics_created_delta(doc)))])
+    no_resi = doc["no_resi"]
 
     return jsonify({
         "status": "success",
@@ -547,57 +1777,134 @@ def create_shipment():
         "tanggal_pembelian": doc["tanggal_pembelian"],
     }), 201
 
+def _status_payload(d: dict) -> dict:
+    c = _canonical(d)
+    return {
+        "status": "success",
+        "no_resi": d["no_resi"],
+        "status_pengiriman": d["status"],
+        "asal": c["origin"],
+        "tujuan": c["dest"],
+        "currency": d.get("currency", "IDR"),
+        "harga_pengiriman": c["price"],
+        "harga_dasar": c["harga_dasar"],
+        "per_kg_factor": c["per_kg_factor"],
+        "included_kg": c["included_kg"],
+        "distributor_id": c["distributor_id"],
+        "distributor_name": c["distributor_name"],
+        "eta_days": c["eta_days"],
+        "eta_text": d.get("eta_text"),
+        "eta_delivery_date": d.get("eta_delivery_date"),
+        "tanggal_pembelian": c["tanggal_pembelian"],
+    }
+
+# Validator kondisional: ETag kuat diturunkan dari updated_at data terkait, sehingga
+# klien yang datanya masih terkini dapat 304 tanpa body diserialisasi ulang.
+# Varian terkompresi diberi sufiks "--<encoding>" pada ETag-nya.
+ETAG_ENCODING_SEP = "--"
+
+def _data_etag(*parts) -> str:
+    return hashlib.sha1("|".join("" if p is None else str(p) for p in parts).encode("utf-8")).hexdigest()
+
+def _matching_etag(etag: str):
+    """Tag dari If-None-Match yang cocok dengan `etag` (apa adanya, termasuk sufiks encoding),
+    atau None. Varian terkompresi hanya cocok bila encoding itu juga yang dinegosiasikan sekarang."""
+    inm = request.if_none_match
+    if not inm:
+        return None
+    if inm.star_tag:
+        return etag
+    for t in inm.as_set(include_weak=True):
+        base, _, enc = t.partition(ETAG_ENCODING_SEP)
+        if base == etag and (not enc or enc == _negotiate_encoding()):
+            return t
+    return None
+
+def _etag_matches(etag: str) -> bool:
+    return _matching_etag(etag) is not None
+
+def _not_modified(etag: str):
+    # 304 membawa validator yang sama dengan 200 yang di-cache klien (bersufiks bila terkompresi)
+    resp = app.response_class(status=304)
+    resp.set_etag(_matching_etag(etag) or etag)
+    resp.vary.add("Accept-Encoding")
+    resp.headers["Cache-Control"] = "public, max-age=0, must-revalidate"
+    return resp
+
+# Cache body JSON /status yang sudah diserialisasi, per no_resi (LRU + TTL).
+_status_cache = OrderedDict()
+_status_cache_lock = threading.Lock()
+_status_cache_stats = {"hits": 0, "misses": 0, "invalidations": 0, "evictions": 0}
+
+def _status_cache_get(no_resi: str):
+    with _status_cache_lock:
+        entry = _status_cache.get(no_resi)
+        if entry is not None and entry["expires_at"] <= time.monotonic():
+            del _status_cache[no_resi]
+            entry = None
+        if entry is None:
+            _status_cache_stats["misses"] += 1
+            return None
+        _status_cache.move_to_end(no_resi)
+        _status_cache_stats["hits"] += 1
+        return entry
+
+def _status_cache_put(no_resi: str, body: bytes, etag: str) -> dict:
+    entry = {
+        "body": body,
+        "etag": etag,
+        "expires_at": time.monotonic() + STATUS_CACHE_TTL_SECS,
+    }
+    with _status_cache_lock:
+        _status_cache[no_resi] = entry
+        _status_cache.move_to_end(no_resi)
+        while len(_status_cache) > STATUS_CACHE_MAX:
+            _status_cache.popitem(last=False)
+            _status_cache_stats["evictions"] += 1
+    return entry
+
+def _status_cache_invalidate(no_resi: str):
+    if not no_resi:
+        return
+    with _status_cache_lock:
+        if _status_cache.pop(no_resi, None) is not None:
+            _status_cache_stats["invalidations"] += 1
+
+def _status_cache_report() -> dict:
+    with _status_cache_lock:
+        hits, misses = _status_cache_stats["hits"], _status_cache_stats["misses"]
+        return {
+            "size": len(_status_cache),
+            "max_size": STATUS_CACHE_MAX,
+            "ttl_secs": STATUS_CACHE_TTL_SECS,
+            **_status_cache_stats,
+            "hit_ratio": round(hits / (hits + misses), 4) if (hits + misses) else None,
+        }
+
 @app.route("/status", methods=["GET"])
 def get_status():
     no_resi = (request.args.get("no_resi") or "").strip()
     if not no_resi:
         return jsonify({"status": "error", "message": "no_resi wajib."}), 400
 
-    aktif = db.collection(COL_SHIPMENTS).where("no_resi", "==", no_resi).get()
-    if aktif:
-        d = aktif[0].to_dict()
-        return jsonify({
-            "status": "success",
-            "no_resi": d["no_resi"],
-            "status_pengiriman": d["status"],
-            "asal": d.get("asal_pengirim") or d.get("asal_supplier"),
-            "tujuan": d.get("tujuan") or d.get("tujuan_retail"),
-            "currency": d.get("currency", "IDR"),
-            "harga_pengiriman": d.get("harga_pengiriman") or d.get("biaya_pengiriman"),
-            "harga_dasar": d.get("harga_dasar"),
-            "per_kg_factor": d.get("per_kg_factor"),
-            "included_kg": d.get("included_kg"),
-            "distributor_id": d.get("distributor_id"),
-            "distributor_name": d.get("distributor_name") or d.get("nama_distributor"),
-            "eta_days": d.get("eta_days"),
-            "eta_text": d.get("eta_text"),
-            "eta_delivery_date": d.get("eta_delivery_date"),
-            "tanggal_pembelian": d.get("tanggal_pembelian"),
-        }), 200
-
-    arsip = db.collection(COL_HISTORY).where("no_resi", "==", no_resi).get()
-    if arsip:
-        d = arsip[0].to_dict()
-        return jsonify({
-            "status": "success",
-            "no_resi": d["no_resi"],
-            "status_pengiriman": d["status"],
-            "asal": d.get("asal_pengirim") or d.get("asal_supplier"),
-            "tujuan": d.get("tujuan") or d.get("tujuan_retail"),
-            "currency": d.get("currency", "IDR"),
-            "harga_pengiriman": d.get("harga_pengiriman") or d.get("biaya_pengiriman"),
-            "harga_dasar": d.get("harga_dasar"),
-            "per_kg_factor": d.get("per_kg_factor"),
-            "included_kg": d.get("included_kg"),
-            "distributor_id": d.get("distributor_id"),
-            "distributor_name": d.get("distributor_name") or d.get("nama_distributor"),
-            "eta_days": d.get("eta_days"),
-            "eta_text": d.get("eta_text"),
-            "eta_delivery_date": d.get("eta_delivery_date"),
-            "tanggal_pembelian": d.get("tanggal_pembelian"),
-        }), 200
-
-    return jsonify({"status": "error", "message": "Nomor resi tidak ditemukan."}), 404
+    entry = _status_cache_get(no_resi)
+    if entry is None:
+        found = _find_shipment_by_resi(no_resi)
+        if not found:
+            return jsonify({"status": "error", "message": "Nomor resi tidak ditemukan."}), 404
+        d = found[2]
+        etag = _data_etag("status", no_resi, found[0], d.get("status"), d.get("updated_at")) if d.get("updated_at") else None
+        if etag and _etag_matches(etag):
+            return _not_modified(etag)
+        body = (app.json.dumps(_status_payload(d)) + "\n").encode("utf-8")
+        entry = _status_cache_put(no_resi, body, etag or hashlib.sha1(body).hexdigest())
+    elif _etag_matches(entry["etag"]):
+        return _not_modified(entry["etag"])
+
+    resp = app.response_class(entry["body"], status=200, mimetype="application/json")
+    resp.set_etag(entry["etag"])
+    resp.headers["Cache-Control"] = "public, max-age=0, must-revalidate"
+    return resp
 
 @app.route("/", methods=["GET", "POST"])
 def index():
@@ -610,20 +1917,16 @@ def index():
         if not nomor_resi:
             error = "Nomor resi wajib diisi."
         else:
-            aktif = db.collection(COL_SHIPMENTS).where("no_resi", "==", nomor_resi).get()
-            if aktif:
-                status_text = aktif[0].to_dict().get("status")
+            found = _find_shipment_by_resi(nomor_resi)
+            if found:
+                status_text = found[2].get("status")
             else:
-                arsip = db.collection(COL_HISTORY).where("no_resi", "==", nomor_resi).get()
-                if arsip:
-                    status_text = arsip[0].to_dict().get("status")
-                else:
-                    error = "Nomor resi tidak ditemukan."
+                error = "Nomor resi tidak ditemukan."
 
     return render_template("index.html", nomor_resi=nomor_resi, status=status_text, error=error)
 
 def get_all_routes():
-    docs = db.collection("routes").stream()
+    docs = db.collection(COL_ROUTES).stream()
     return [d.to_dict() for d in docs]
 
 def upsert_route_doc(origin, destination, price_base, eta_days, distributor_id, distributor_name, per_kg_factor, included_kg):
@@ -638,31 +1941,201 @@ def upsert_route_doc(origin, destination, price_base, eta_days, distributor_id,
         "included_kg": included_kg,
         "updated_at": now_iso(),
     }
-    db.collection("routes").document(f"{origin}_{destination}").set(doc) 
+    db.collection(COL_ROUTES).document(f"{origin}_{destination}").set(doc)
+    _route_cache_put(f"{origin}_{destination}", doc)
+    _neg_route_invalidate(_route_key(origin, destination))
     return doc
 
 def delete_route_doc(origin, destination):
-    db.collection("routes").document(f"{origin}_{destination}").delete()
+    db.collection(COL_ROUTES).document(f"{origin}_{destination}").delete()
+    _route_cache_put(f"{origin}_{destination}", None)
 
 @app.route("/admin", methods=["GET"])
 def admin_page():
-    aktif_docs = db.collection(COL_SHIPMENTS).order_by("created_at").stream()
-    aktif = [d.to_dict() for d in aktif_docs]
-
-    history_docs = db.collection(COL_HISTORY).order_by("created_at").stream()
-    history = [d.to_dict() for d in history_docs]
-
+    # tabel pesanan dimuat per halaman lewat /api/shipments, tidak di-render di sini
     try:
         routes = get_all_routes()
     except Exception:
         routes = []
 
     return render_template("admin.html",
-                            aktif=aktif,
-                            history=history,
                             status_list=STATUS_LIST,
                             routes=routes)
 
+def _status_change_ops(doc_id: str, before: dict, new_status: str, updated_at: str, txn=None,
+                       update_time=None, outbox_snap=None):
+    """Op tulis (format _commit_batched) untuk satu perubahan status: update dokumen, atau
+    langsung diarsipkan ke tb_histori bila selesai, plus delta analytics dan event outbox.
+    Di luar transaksi, `update_time` (waktu baca `before`) jadi precondition tulis dokumen
+    shipment dan `outbox_snap` dokumen coalesce yang sudah dibaca.
+    Return (ops, after, event, coalesced)."""
+    old_status = before.get("status")
+    after = dict(before, status=new_status, updated_at=updated_at)
+    ref = db.collection(COL_SHIPMENTS).document(doc_id)
+    guard = db.write_option(last_update_time=update_time) if update_time is not None else None
+    if new_status == "Pesanan Selesai":
+        ops = [("set", db.collection(COL_HISTORY).document(doc_id), after), ("delete", ref, None, guard)]
+        if after.get("no_resi"):
+            ops.append(("set", *_resi_index_entry(after["no_resi"], COL_HISTORY, doc_id)))
+    else:
+        ops = [("update", ref, {"status": new_status, "updated_at": updated_at}, guard)]
+    delta = _analytics_status_delta(before, old_status, new_status)
+    if delta:
+        ops.append(("merge", *_analytics_entry(delta)))
+    event = _build_status_event(after, old_status=old_status, new_status=new_status)
+    op, coalesced = _outbox_coalesce(event, txn, outbox_snap)
+    ops.append(op)
+    return ops, after, event, coalesced
+
+@firestore.transactional
+def _update_status_txn(txn, doc_id: str, new_status: str):
+    # satu transaksi: baca sekali, hitung `after` lokal, tulis update/arsip + analytics + outbox
+    snap = db.collection(COL_SHIPMENTS).document(doc_id).get(transaction=txn)
+    if not snap.exists:
+        return None
+    # fungsi ini bisa diulang saat transaksi konflik: jangan ubah state proses di sini
+    ops, after, event, coalesced = _status_change_ops(doc_id, snap.to_dict(), new_status, now_iso(), txn)
+    _apply_ops(txn, ops)
+    return after, event, coalesced
+
+# Pub/sub in-process untuk Server-Sent Events. Setiap koneksi SSE hanya memegang deque
+# kecil + Event; publish cukup append dan set(), tanpa thread per klien. Dengan worker
+# gevent (gunicorn -k gevent) ribuan koneksi idle cukup berupa greenlet yang menunggu Event.
+# Event terakhir disimpan di ring buffer untuk replay via Last-Event-ID saat reconnect.
+SSE_ALL = "*"
+
+class _SseClient:
+    __slots__ = ("topic", "items", "ready", "dropped")
+
+    def __init__(self, topic: str):
+        self.topic = topic
+        self.items = deque(maxlen=SSE_CLIENT_QUEUE_MAX)
+        self.ready = threading.Event()
+        self.dropped = 0
+
+    def push(self, item):
+        if len(self.items) == self.items.maxlen:
+            self.dropped += 1
+        self.items.append(item)
+        self.ready.set()
+
+    def drain(self, timeout: float) -> list:
+        self.ready.wait(timeout)
+        self.ready.clear()
+        out = []
+        while self.items:
+            out.append(self.items.popleft())
+        return out
+
+class _EventHub:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.topics = {}
+        self.clients = 0
+        self.epoch = secrets.token_hex(4)
+        self.seq = 0
+        self.recent = deque(maxlen=SSE_REPLAY_MAX)
+        self.stats = {"published": 0, "delivered": 0, "rejected": 0, "dropped": 0}
+
+    def subscribe(self, topic: str, last_event_id: str = ""):
+        """Return (client, event untuk di-replay) atau (None, []) bila kapasitas penuh."""
+        with self.lock:
+            if self.clients >= SSE_MAX_CLIENTS:
+                self.stats["rejected"] += 1
+                return None, []
+            client = _SseClient(topic)
+            self.topics.setdefault(topic, set()).add(client)
+            self.clients += 1
+            epoch, _, seq = (last_event_id or "").partition(":")
+            replay = []
+            if epoch == self.epoch and seq.isdigit():
+                replay = [(n, ev) for n, t, ev in self.recent
+                          if n > int(seq) and (topic == SSE_ALL or t == topic)]
+            return client, replay
+
+    def unsubscribe(self, client: _SseClient):
+        with self.lock:
+            subs = self.topics.get(client.topic)
+            if subs is not None and client in subs:
+                subs.discard(client)
+                if not subs:
+                    del self.topics[client.topic]
+                self.clients -= 1
+                self.stats["dropped"] += client.dropped
+
+    def publish(self, topic: str, event: dict):
+        if not topic:
+            return
+        with self.lock:
+            self.seq += 1
+            self.recent.append((self.seq, topic, event))
+            targets = list(self.topics.get(topic, ())) + list(self.topics.get(SSE_ALL, ()))
+            self.stats["published"] += 1
+            self.stats["delivered"] += len(targets)
+            item = (self.seq, event)
+        for client in targets:
+            client.push(item)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                "clients": self.clients,
+                "topics": len(self.topics),
+                "admin_clients": len(self.topics.get(SSE_ALL, ())),
+                "max_clients": SSE_MAX_CLIENTS,
+                "replay_buffer": len(self.recent),
+                **self.stats,
+            }
+
+_event_hub = _EventHub()
+
+def _sse_format(seq: int, event: dict) -> str:
+    data = json.dumps(event, ensure_ascii=False, default=str)
+    return f"id: {_event_hub.epoch}:{seq}\nevent: {event.get('type') or 'message'}\ndata: {data}\n\n"
+
+def _sse_stream(client: _SseClient, replay):
+    try:
+        yield f"retry: {SSE_RETRY_MS}\n\n"
+        for seq, event in replay:
+            yield _sse_format(seq, event)
+        while True:
+            items = client.drain(SSE_HEARTBEAT_SECS)
+            if not items:
+                yield ": ping\n\n"
+            for seq, event in items:
+                yield _sse_format(seq, event)
+    finally:
+        _event_hub.unsubscribe(client)
+
+@app.route("/api/events/stream", methods=["GET"])
+def events_stream():
+    """SSE shipment.status.updated untuk satu resi (?no_resi=), atau semua resi untuk admin."""
+    no_resi = (request.args.get("no_resi") or "").strip()
+    if not no_resi and not session.get("is_admin"):
+        return jsonify({"status": "error", "message": "no_resi wajib (stream semua resi khusus admin)."}), 400
+
+    client, replay = _event_hub.subscribe(no_resi or SSE_ALL, request.headers.get("Last-Event-ID", ""))
+    if client is None:
+        return jsonify({"status": "error", "message": "Terlalu banyak koneksi stream, coba lagi nanti."}), 503
+    resp = app.response_class(_sse_stream(client, replay), mimetype="text/event-stream")
+    resp.call_on_close(lambda: _event_hub.unsubscribe(client))
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
+
+def _status_changed(doc_id: str, after: dict, event: dict, coalesced: bool = False):
+    # dipanggil setelah commit, jadi penghitung tidak ikut naik saat transaksi di-retry
+    if coalesced:
+        _outbox_state["coalesced"] += 1
+    # view dulu, baru cache dibuang: /status berikutnya mengisi cache dari data baru
+    _view_write_through(doc_id, after)
+    _status_cache_invalidate(after.get("no_resi"))
+    _event_hub.publish(after.get("no_resi"), event)
+    try:
+        _direct_broadcast_async(event, after)
+    except Exception as e:
+        app.logger.exception(f"[DIRECT BROADCAST ERROR] {e}")
+
 @app.route("/status/update", methods=["POST"])
 def update_status():
     doc_id = (request.form.get("doc_id") or "").strip()
@@ -673,33 +2146,105 @@ def update_status():
     if new_status not in STATUS_LIST:
         return jsonify({"status": "error", "message": "status tidak valid."}), 400
 
-    ref = db.collection(COL_SHIPMENTS).document(doc_id)
-    snap = ref.get()
-    if not snap.exists:
+    res = _update_status_txn(db.transaction(), doc_id, new_status)
+    if res is None:
         return jsonify({"status": "error", "message": "Dokumen tidak ditemukan."}), 404
+    _outbox_wakeup.set()
+    _status_changed(doc_id, *res)
 
-    before = snap.to_dict()
-    old_status = before.get("status")
-
-    ref.update({"status": new_status, "updated_at": now_iso()})
-    after = ref.get().to_dict()
-
-    try:
-        _notify_status_change(after, old_status=old_status, new_status=new_status)
-    except Exception as e:
-        print("[WEBHOOK ERROR]", e)
+    return redirect(url_for("admin_page"))
 
-    try:
-        event = _build_status_event(after, old_status=old_status, new_status=new_status)
-        _direct_broadcast_async(event)
-    except Exception as e:
-        app.logger.exception(f"[DIRECT BROADCAST ERROR] {e}")
+@app.route("/api/status/bulk-update", methods=["POST"])
+@admin_required
+def bulk_update_status():
+    data = request.get_json(force=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({"status": "error", "message": "Body harus object."}), 400
+    for fld in ("doc_ids", "no_resi"):
+        if data.get(fld) is not None and not isinstance(data[fld], list):
+            return jsonify({"status": "error", "message": f"{fld} harus list."}), 400
+    new_status = (str(data.get("status") or "")).strip()
+    doc_ids = [str(x).strip() for x in (data.get("doc_ids") or []) if str(x).strip()]
+    resis = [str(x).strip() for x in (data.get("no_resi") or []) if str(x).strip()]
 
-    if new_status == "Pesanan Selesai":
-        db.collection(COL_HISTORY).document(doc_id).set(after)
-        ref.delete()
+    if new_status not in STATUS_LIST:
+        return jsonify({"status": "error", "message": "status tidak valid."}), 400
+    if not doc_ids and not resis:
+        return jsonify({"status": "error", "message": "doc_ids atau no_resi wajib."}), 400
+    if len(doc_ids) + len(resis) > MAX_BULK_STATUS_UPDATES:
+        return jsonify({"status": "error", "message": f"Maksimal {MAX_BULK_STATUS_UPDATES} pesanan per request."}), 400
+
+    results = []
+    targets = dict.fromkeys(doc_ids)   # doc_id -> no_resi yang diminta (urutan dipertahankan)
+
+    if resis:
+        idx = {s.id: (s.to_dict() or {}) for s in
+               db.get_all([db.collection(COL_RESI_INDEX).document(r) for r in dict.fromkeys(resis)]) if s.exists}
+        for r in dict.fromkeys(resis):
+            ptr = idx.get(r)
+            if ptr is None:
+                found = _find_shipment_by_resi(r)
+                ptr = {"collection": found[0], "doc_id": found[1]} if found else None
+            if ptr is None:
+                results.append({"no_resi": r, "status": "error", "code": 404, "message": "resi tidak ditemukan."})
+            elif ptr.get("collection") != COL_SHIPMENTS:
+                results.append({"no_resi": r, "status": "error", "code": 409, "message": "pesanan sudah selesai."})
+            else:
+                targets.setdefault(ptr["doc_id"], r)
+
+    snaps = {s.id: s for s in db.get_all([db.collection(COL_SHIPMENTS).document(d) for d in targets]) if s.exists}
+    outbox_snaps = {}
+    if COALESCE_WINDOW_SECS > 0:
+        resi_set = {s.get("no_resi") for s in snaps.values() if s.get("no_resi")}
+        outbox_snaps = {s.id: s for s in db.get_all([_coalesce_ref(r) for r in resi_set])}
+    updated_at = now_iso()
+    groups, changes, seen_resi = [], [], set()
+    for doc_id in targets:
+        snap = snaps.get(doc_id)
+        if snap is None:
+            results.append({"doc_id": doc_id, "status": "error", "code": 404, "message": "Dokumen tidak ditemukan."})
+            continue
+        before = snap.to_dict()
+        resi = before.get("no_resi")
+        # resi ganda dalam satu request: dokumen coalesce-nya dibaca ulang saat menulis, bukan dari prefetch
+        osnap = outbox_snaps.get(f"coalesce_{resi}") if resi not in seen_resi else None
+        seen_resi.add(resi)
+        # precondition update_time: bila dokumen berubah (update/arsip lain) sejak get_all, grup gagal
+        ops, after, event, coalesced = _status_change_ops(doc_id, before, new_status, updated_at,
+                                                          update_time=snap.update_time, outbox_snap=osnap)
+        groups.append(ops)
+        changes.append((doc_id, after, event, coalesced))
+
+    errors = _commit_batched(groups)
+    ok = 0
+    for (doc_id, after, event, coalesced), err in zip(changes, errors):
+        if err:
+            # precondition gagal atau batch lain di chunk yang sama gagal: ulangi per dokumen dalam transaksi
+            try:
+                res = _update_status_txn(db.transaction(), doc_id, new_status)
+            except Exception as e:
+                results.append({"doc_id": doc_id, "no_resi": after.get("no_resi"), "status": "error",
+                                "code": 500, "message": f"Gagal menyimpan: {e}"})
+                continue
+            if res is None:
+                results.append({"doc_id": doc_id, "no_resi": after.get("no_resi"), "status": "error",
+                                "code": 404, "message": "Dokumen tidak ditemukan."})
+                continue
+            after, event, coalesced = res
+        _status_changed(doc_id, after, event, coalesced)
+        results.append({"doc_id": doc_id, "no_resi": after.get("no_resi"), "status": "success"})
+        ok += 1
+    if ok:
+        _outbox_wakeup.set()
 
-    return redirect(url_for("admin_page"))
+    return jsonify({
+        "status": "success",
+        "new_status": new_status,
+        "count": len(results),
+        "ok": ok,
+        "failed": len(results) - ok,
+        "results": results,
+    }), 200
 
 @app.route("/admin/routes/upsert", methods=["POST"])
 def admin_upsert_route():
@@ -737,15 +2282,466 @@ def admin_delete_route():
     delete_route_doc(origin, destination)
     return redirect(url_for("admin_page"))
 
+SHIPMENT_SCOPES = {"aktif": COL_SHIPMENTS, "history": COL_HISTORY}
+
+def _shipments_filters(args):
+    """Filter list shipments dari query string: (status, origin, dest, created_from, created_before)."""
+    status = (args.get("status") or "").strip()
+    origin = (args.get("origin") or "").strip().lower()
+    dest = (args.get("dest") or "").strip().lower()
+    date_from = (args.get("date_from") or "").strip()
+    date_to = (args.get("date_to") or "").strip()
+    try:
+        lo = datetime.strptime(date_from, "%Y-%m-%d").strftime("%Y-%m-%d") if date_from else ""
+        hi = (datetime.strptime(date_to, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d") if date_to else ""
+    except ValueError:
+        raise ValueError("date_from/date_to harus format YYYY-MM-DD.")
+    return status, origin, dest, lo, hi
+
+def _shipments_query(col: str, args):
+    """Query tb_pengiriman/tb_histori terbaru dulu, dengan filter status, rute dan tanggal (created_at).
+    Filter rute memakai field route_origin/route_dest yang ditulis saat create."""
+    status, origin, dest, lo, hi = _shipments_filters(args)
+    q = db.collection(col)
+    if status:
+        q = q.where("status", "==", status)
+    if origin:
+        q = q.where("route_origin", "==", origin)
+    if dest:
+        q = q.where("route_dest", "==", dest)
+    if lo:
+        q = q.where("created_at", ">=", lo)
+    if hi:
+        q = q.where("created_at", "<", hi)
+    # __name__ eksplisit (arah sama dengan urutan implisit) agar cursor nilai (created_at, doc_id) bisa dipakai
+    return (q.order_by("created_at", direction=firestore.Query.DESCENDING)
+             .order_by("__name__", direction=firestore.Query.DESCENDING))
+
+def _encode_cursor(doc_id: str, d: dict) -> str:
+    raw = json.dumps([d.get("created_at"), doc_id], default=str, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+def _decode_cursor(col: str, token: str):
+    """Cursor -> (created_at, doc_id). Cursor berisi nilai, bukan referensi dokumen, sehingga tetap
+    berlaku walau baris terakhir halaman sudah diarsipkan. Cursor lama (doc_id polos) masih diterima."""
+    try:
+        created_at, doc_id = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        if isinstance(doc_id, str) and doc_id and created_at is not None:
+            return created_at, doc_id
+    except (ValueError, TypeError):
+        pass
+    snap = db.collection(col).document(token).get()
+    if not snap.exists or (snap.to_dict() or {}).get("created_at") is None:
+        raise ValueError("cursor tidak valid.")
+    return snap.to_dict()["created_at"], snap.id
+
+def _stream_shipments(queries):
+    """Generator NDJSON: satu baris per shipment, diambil per halaman SHIPMENTS_PAGE_MAX
+    (stream() per halaman) supaya memori datar dan tidak kena deadline stream panjang.
+    Query boleh diganti list dokumen yang sudah jadi (dari view in-memory)."""
+    for scope, q in queries:
+        if isinstance(q, list):
+            for d in q:
+                yield json.dumps(dict(_normalize_doc(d), collection=scope), ensure_ascii=False, default=str) + "\n"
+            continue
+        last = None
+        while True:
+            page = (q.start_after(last) if last is not None else q).limit(SHIPMENTS_PAGE_MAX)
+            n = 0
+            for s in page.stream():
+                n += 1
+                last = s
+                row = dict(_normalize_doc(s.to_dict()), collection=scope)
+                yield json.dumps(row, ensure_ascii=False, default=str) + "\n"
+            if n < SHIPMENTS_PAGE_MAX:
+                break
+
+# View in-memory tb_pengiriman (opsional, SHIPMENT_VIEW_ENABLED=1): diisi listener on_snapshot
+# secara inkremental (added/modified/removed) dan di-index per no_resi, status dan rute.
+# "order" berisi (created_at, doc_id) terurut untuk list terbaru dulu. Sebelum snapshot
+# pertama tiba, pembaca tetap query ke Firestore. Perubahan status dari proses ini ditulis
+# langsung ke view (write-through); "tombstones" = doc_id yang sudah dihapus/diarsip ->
+# (updated_at, kedaluwarsa), dicatat baik dari REMOVED listener maupun dari write-through arsip,
+# supaya snapshot lama atau write-through yang datang belakangan tidak memunculkannya lagi.
+# Tombstone dibuang setelah SHIPMENT_VIEW_TOMBSTONE_SECS.
+_shipment_view = {
+    "by_id": {}, "by_resi": {}, "by_status": {}, "by_route": {}, "order": [], "tombstones": {},
+    "listener": None, "ready": False, "snapshots": 0, "changes": 0, "errors": 0,
+    "last_snapshot_at": None, "lag_secs": None,
+}
+_shipment_view_lock = threading.Lock()
+
+def _view_unindex(doc_id: str, d: dict):
+    v = _shipment_view
+    if d.get("no_resi") and v["by_resi"].get(d["no_resi"]) == doc_id:
+        del v["by_resi"][d["no_resi"]]
+    for index, key in ((v["by_status"], d.get("status")), (v["by_route"], (d.get("route_origin"), d.get("route_dest")))):
+        ids = index.get(key)
+        if ids is not None:
+            ids.discard(doc_id)
+            if not ids:
+                del index[key]
+    if d.get("created_at") is not None:
+        key = (str(d["created_at"]), doc_id)
+        i = bisect.bisect_left(v["order"], key)
+        if i < len(v["order"]) and v["order"][i] == key:
+            del v["order"][i]
+
+def _view_index(doc_id: str, d: dict):
+    v = _shipment_view
+    if d.get("no_resi"):
+        v["by_resi"][d["no_resi"]] = doc_id
+    v["by_status"].setdefault(d.get("status"), set()).add(doc_id)
+    v["by_route"].setdefault((d.get("route_origin"), d.get("route_dest")), set()).add(doc_id)
+    if d.get("created_at") is not None:
+        bisect.insort(v["order"], (str(d["created_at"]), doc_id))
+
+def _view_apply(doc_id: str, d):
+    """Ganti isi view untuk doc_id dengan `d` (None = hapus). Dipanggil dengan lock dipegang."""
+    v = _shipment_view
+    old = v["by_id"].pop(doc_id, None)
+    if old is not None:
+        _view_unindex(doc_id, old)
+    if d is not None:
+        v["by_id"][doc_id] = d
+        _view_index(doc_id, d)
+
+def _view_is_stale(doc_id: str, d: dict) -> bool:
+    # view sudah memegang versi yang lebih baru (dari write-through) daripada snapshot ini
+    v = _shipment_view
+    cur = v["by_id"].get(doc_id)
+    if cur is not None:
+        return cur.get("updated_at") is not None and str(d.get("updated_at") or "") < str(cur["updated_at"])
+    # versi yang sama dengan saat dihapus juga basi
+    removed = v["tombstones"].get(doc_id)
+    return removed is not None and str(d.get("updated_at") or "") <= str(removed[0] or "")
+
+def _view_tombstone(doc_id: str, updated_at):
+    v = _shipment_view
+    prev = v["tombstones"].get(doc_id)
+    if prev is not None and str(prev[0] or "") > str(updated_at or ""):
+        updated_at = prev[0]
+    v["tombstones"][doc_id] = (updated_at, time.monotonic() + SHIPMENT_VIEW_TOMBSTONE_SECS)
+
+def _on_shipments_snapshot(col_snapshot, changes, read_time):
+    v = _shipment_view
+    try:
+        with _shipment_view_lock:
+            for ch in changes:
+                doc_id = ch.document.id
+                if ch.type.name == "REMOVED":
+                    old = v["by_id"].get(doc_id) or ch.document.to_dict() or {}
+                    _view_tombstone(doc_id, old.get("updated_at"))
+                    _view_apply(doc_id, None)
+                    continue
+                d = ch.document.to_dict() or {}
+                if not _view_is_stale(doc_id, d):
+                    v["tombstones"].pop(doc_id, None)
+                    _view_apply(doc_id, d)
+            now = time.monotonic()
+            for doc_id in [k for k, (_, exp) in v["tombstones"].items() if exp <= now]:
+                del v["tombstones"][doc_id]
+            v["snapshots"] += 1
+            v["changes"] += len(changes)
+            v["ready"] = True
+            v["last_snapshot_at"] = time.monotonic()
+            if read_time is not None:
+                v["lag_secs"] = round(max(0.0, time.time() - read_time.timestamp()), 3)
+    except Exception as e:
+        with _shipment_view_lock:
+            v["errors"] += 1
+        app.logger.warning(f"[ShipmentView] gagal menerapkan snapshot: {e}")
+
+def _shipment_view_start():
+    if not SHIPMENT_VIEW_ENABLED:
+        return
+    try:
+        _shipment_view["listener"] = db.collection(COL_SHIPMENTS).on_snapshot(_on_shipments_snapshot)
+    except Exception as e:
+        app.logger.warning(f"[ShipmentView] listener tidak tersedia, pakai query Firestore: {e}")
+
+def _view_write_through(doc_id: str, after: dict):
+    """Terapkan perubahan status yang baru di-commit proses ini ke view, tanpa menunggu listener."""
+    with _shipment_view_lock:
+        v = _shipment_view
+        if not v["ready"]:
+            return
+        if after.get("status") == STATUS_LIST[-1]:
+            _view_tombstone(doc_id, after.get("updated_at"))
+            _view_apply(doc_id, None)
+        elif doc_id in v["tombstones"]:
+            # dokumen sudah dihapus setelah update ini ter-commit (update ke dokumen yang tidak
+            # ada pasti gagal), jadi write-through yang datang belakangan selalu basi
+            return
+        elif not _view_is_stale(doc_id, after):
+            _view_apply(doc_id, dict(after))
+
+def _view_by_resi(no_resi: str):
+    with _shipment_view_lock:
+        v = _shipment_view
+        doc_id = v["by_resi"].get(no_resi) if v["ready"] else None
+        return (COL_SHIPMENTS, doc_id, v["by_id"][doc_id]) if doc_id else None
+
+def _view_select(args, after=None, limit: int = None):
+    """Padanan _shipments_query(COL_SHIPMENTS, args) dari view: list (doc_id, dict) terbaru dulu,
+    setelah posisi `after` = (created_at, doc_id) bila diisi. None bila view belum siap."""
+    status, origin, dest, lo, hi = _shipments_filters(args)
+    with _shipment_view_lock:
+        v = _shipment_view
+        if not v["ready"]:
+            return None
+        by_id, order = v["by_id"], v["order"]
+        top = (str(after[0]), after[1]) if after is not None else None
+
+        if status or (origin and dest):
+            ids = v["by_status"].get(status, ()) if status else v["by_route"].get((origin, dest), ())
+            keys = sorted(((str(by_id[i]["created_at"]), i) for i in ids if by_id[i].get("created_at") is not None),
+                          reverse=True)
+        else:
+            i0 = bisect.bisect_left(order, (lo,)) if lo else 0
+            i1 = bisect.bisect_left(order, (hi,)) if hi else len(order)
+            if top is not None:
+                i1 = min(i1, bisect.bisect_left(order, top))
+            keys = (order[j] for j in range(i1 - 1, i0 - 1, -1))
+
+        out = []
+        for key in keys:
+            if (lo and key[0] < lo) or (hi and key[0] >= hi) or (top is not None and key >= top):
+                continue
+            d = by_id[key[1]]
+            if ((status and d.get("status") != status) or (origin and d.get("route_origin") != origin)
+                    or (dest and d.get("route_dest") != dest)):
+                continue
+            out.append((key[1], d))
+            if limit is not None and len(out) >= limit:
+                break
+        return out
+
+def _shipment_view_stats() -> dict:
+    with _shipment_view_lock:
+        v = _shipment_view
+        last = v["last_snapshot_at"]
+        return {
+            "enabled": SHIPMENT_VIEW_ENABLED,
+            "mode": "listener" if v["listener"] is not None else "off",
+            "ready": v["ready"],
+            "shipments": len(v["by_id"]),
+            "statuses": {st: len(ids) for st, ids in v["by_status"].items()},
+            "routes": len(v["by_route"]),
+            "snapshots": v["snapshots"],
+            "changes": v["changes"],
+            "lag_secs": v["lag_secs"],
+            "age_secs": round(time.monotonic() - last, 1) if last is not None else None,
+            "errors": v["errors"],
+        }
+
+def _shipments_etag(*row_lists) -> str:
+    """ETag /api/shipments dari baris yang memang dikirim: parameter request (filter, cursor,
+    limit) plus (doc_id, updated_at) tiap baris. Tidak butuh query tambahan; berubah bila
+    isi halaman berubah (update status, arsip, dokumen baru yang masuk halaman)."""
+    parts = ["shipments", sorted(request.args.items(multi=True))]
+    for rows in row_lists:
+        parts.append(len(rows))
+        parts.extend(f"{doc_id}@{d.get('updated_at')}" for doc_id, d in rows)
+    return _data_etag(*parts)
+
 @app.route("/api/shipments", methods=["GET"])
 def api_shipments():
-    aktif = [_normalize_doc(x.to_dict())
-                for x in db.collection("tb_pengiriman").order_by("created_at").stream()]
-    history = [_normalize_doc(x.to_dict())
-                for x in db.collection("tb_histori").order_by("created_at").stream()]
-    aktif.sort(key=lambda x: x["created_at"], reverse=True)
-    history.sort(key=lambda x: x["created_at"], reverse=True)
-    return jsonify({"aktif": aktif, "history": history}), 200
+    scope = (request.args.get("collection") or "").strip().lower()
+    stream = (request.args.get("stream") in ("1", "true")
+              or request.accept_mimetypes.best_match(["application/json", "application/x-ndjson"]) == "application/x-ndjson")
+    try:
+        if stream:
+            # stream tidak diberi ETag: baris baru dibaca sambil dikirim
+            if scope and scope not in SHIPMENT_SCOPES:
+                return jsonify({"status": "error", "message": "collection harus 'aktif' atau 'history'."}), 400
+            scopes = [scope] if scope else list(SHIPMENT_SCOPES)
+            queries = []
+            for s in scopes:
+                rows = _view_select(request.args) if s == "aktif" else None
+                queries.append((s, [d for _, d in rows] if rows is not None else _shipments_query(SHIPMENT_SCOPES[s], request.args)))
+            return app.response_class(_stream_shipments(queries), mimetype="application/x-ndjson")
+
+        if not scope:
+            # Tanpa ?collection= : bentuk lama {aktif, history} lengkap.
+            aktif = _view_select(request.args)
+            if aktif is None:
+                aktif = [(x.id, x.to_dict()) for x in _shipments_query(COL_SHIPMENTS, request.args).stream()]
+            history = [(x.id, x.to_dict()) for x in _shipments_query(COL_HISTORY, request.args).stream()]
+            etag = _shipments_etag(aktif, history)
+            if _etag_matches(etag):
+                return _not_modified(etag)
+            resp = jsonify({"aktif": [_normalize_doc(d) for _, d in aktif],
+                            "history": [_normalize_doc(d) for _, d in history]})
+            resp.set_etag(etag)
+            return resp
+
+        if scope not in SHIPMENT_SCOPES:
+            return jsonify({"status": "error", "message": "collection harus 'aktif' atau 'history'."}), 400
+        col = SHIPMENT_SCOPES[scope]
+        q = _shipments_query(col, request.args)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    try:
+        limit = int(request.args.get("limit") or SHIPMENTS_PAGE_DEFAULT)
+    except ValueError:
+        return jsonify({"status": "error", "message": "limit harus angka."}), 400
+    limit = max(1, min(limit, SHIPMENTS_PAGE_MAX))
+
+    cursor = (request.args.get("cursor") or "").strip()
+    try:
+        after = _decode_cursor(col, cursor) if cursor else None
+        rows = _view_select(request.args, after, limit + 1) if col == COL_SHIPMENTS else None
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    if rows is None:
+        if after is not None:
+            q = q.start_after({"created_at": after[0], "__name__": after[1]})
+        rows = [(s.id, s.to_dict()) for s in q.limit(limit + 1).stream()]
+
+    # baris ke-(limit+1) ikut di-hash: has_more/next_cursor juga bagian dari body
+    etag = _shipments_etag(rows)
+    if _etag_matches(etag):
+        return _not_modified(etag)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    resp = jsonify({
+        "collection": scope,
+        "items": [_normalize_doc(d) for _, d in rows],
+        "limit": limit,
+        "has_more": has_more,
+        "next_cursor": _encode_cursor(*rows[-1]) if (has_more and rows) else None,
+    })
+    resp.set_etag(etag)
+    return resp
+
+# Rollup analytics: beberapa dokumen shard di tb_analytics yang di-increment saat
+# shipment dibuat / status berubah. GET /api/analytics cukup menjumlah shard.
+MONTH_LABELS = ["Jan", "Feb", "Mar", "Apr", "Mei", "Jun", "Jul", "Agu", "Sep", "Okt", "Nov", "Des"]
+
+def _deep_add(acc: dict, delta: dict) -> dict:
+    for k, v in delta.items():
+        if isinstance(v, dict):
+            _deep_add(acc.setdefault(k, {}), v)
+        else:
+            acc[k] = acc.get(k, 0) + v
+    return acc
+
+def _to_increments(delta: dict) -> dict:
+    return {k: (_to_increments(v) if isinstance(v, dict) else firestore.Increment(v)) for k, v in delta.items()}
+
+def _analytics_entry(delta: dict):
+    shard = db.collection(COL_ANALYTICS).document(f"shard_{secrets.randbelow(ANALYTICS_SHARDS)}")
+    return shard, _to_increments(delta)
+
+def _analytics_apply(delta: dict):
+    ref, data = _analytics_entry(delta)
+    ref.set(data, merge=True)
+
+def _purchase_day(d: dict):
+    day = str(d.get("tanggal_pembelian") or "")[:10] or str(d.get("created_at") or "")[:10]
+    try:
+        datetime.strptime(day, "%Y-%m-%d")
+        return day
+    except ValueError:
+        return None
+
+def _analytics_created_delta(d: dict) -> dict:
+    price = int(d.get("biaya_pengiriman") or d.get("harga_pengiriman") or 0)
+    origin = d.get("route_origin") or _route_key(d.get("asal_pengirim") or d.get("asal_supplier"), "")[0] or "-"
+    dest = d.get("route_dest") or _route_key("", d.get("tujuan") or d.get("tujuan_retail"))[1] or "-"
+    delta = {
+        "total": 1,
+        "revenue_total": price,
+        "status_counts": {d.get("status") or "-": 1},
+        "routes": {f"{origin}→{dest}": {"count": 1, "revenue": price}},
+    }
+    day = _purchase_day(d)
+    if day:
+        delta["count_by_day"] = {day: 1}
+        delta["count_by_month"] = {day[:7]: 1}
+        delta["revenue_by_month"] = {day[:7]: price}
+    if d.get("eta_days"):
+        delta["eta_days_sum"] = int(d["eta_days"])
+        delta["eta_days_count"] = 1
+    return delta
+
+def _analytics_status_delta(d: dict, old_status: str, new_status: str) -> dict:
+    if old_status == new_status:
+        return {}
+    delta = {"status_counts": {old_status or "-": -1, new_status: 1}}
+    day = _purchase_day(d)
+    if day and (new_status == STATUS_LIST[-1] or old_status == STATUS_LIST[-1]):
+        delta["completed_by_month"] = {day[:7]: 1 if new_status == STATUS_LIST[-1] else -1}
+    return delta
+
+def _analytics_rollup() -> dict:
+    total = {}
+    for s in db.collection(COL_ANALYTICS).stream():
+        _deep_add(total, s.to_dict() or {})
+    return total
+
+@app.route("/api/analytics", methods=["GET"])
+def api_analytics():
+    try:
+        months_back = max(1, min(int(request.args.get("months") or 6), 36))
+        top_n = max(1, min(int(request.args.get("top") or 5), 50))
+    except ValueError:
+        return jsonify({"status": "error", "message": "months/top harus angka."}), 400
+
+    r = _analytics_rollup()
+    status_counts = r.get("status_counts", {})
+    total = int(r.get("total", 0))
+    proses = int(status_counts.get(STATUS_LIST[0], 0))
+    kirim = int(sum(status_counts.get(s, 0) for s in STATUS_LIST[1:-1]))
+    selesai = int(status_counts.get(STATUS_LIST[-1], 0))
+
+    week_ago = (datetime.now() - timedelta(days=7)).strftime("%Y-%m-%d")
+    this_week = int(sum(n for day, n in r.get("count_by_day", {}).items() if day >= week_ago))
+    last_week = total - this_week
+    growth = round((this_week - last_week) / last_week * 100) if last_week > 0 else (100 if this_week > 0 else 0)
+
+    now = datetime.now()
+    monthly = []
+    for i in range(months_back - 1, -1, -1):
+        y, m = divmod(now.year * 12 + now.month - 1 - i, 12)
+        key = f"{y:04d}-{m + 1:02d}"
+        monthly.append({
+            "month": key,
+            "label": MONTH_LABELS[m],
+            "count": int(r.get("count_by_month", {}).get(key, 0)),
+            "revenue": int(r.get("revenue_by_month", {}).get(key, 0)),
+            "completed": int(r.get("completed_by_month", {}).get(key, 0)),
+        })
+
+    routes = []
+    for key, v in r.get("routes", {}).items():
+        if not v.get("count"):
+            continue
+        origin, _, dest = key.partition("→")
+        routes.append({"origin": origin, "destination": dest,
+                       "count": int(v.get("count", 0)), "revenue": int(v.get("revenue", 0))})
+
+    eta_count = r.get("eta_days_count", 0)
+    return jsonify({
+        "status": "success",
+        "total": total,
+        "proses": proses,
+        "kirim": kirim,
+        "selesai": selesai,
+        "status_counts": {k: int(v) for k, v in status_counts.items() if v},
+        "growth": growth,
+        "this_week": this_week,
+        "completion_rate": round(selesai / total * 100) if total else 0,
+        "revenue_total": int(r.get("revenue_total", 0)),
+        "avg_eta_days": round(r.get("eta_days_sum", 0) / eta_count) if eta_count else 0,
+        "active_routes": len(routes),
+        "monthly": monthly,
+        "top_routes_by_volume": sorted(routes, key=lambda x: x["count"], reverse=True)[:top_n],
+        "top_routes_by_revenue": sorted(routes, key=lambda x: x["revenue"], reverse=True)[:top_n],
+        "generated_at": now_iso(),
+    }), 200
 
 @app.route("/webhooks/subscribe", methods=["POST"])
 def webhooks_subscribe():
@@ -766,8 +2762,20 @@ def webhooks_subscribe():
         "is_active": True,
         "created_at": now_iso(),
     }
+    batch = data.get("batch")
+    if batch:
+        try:
+            max_events = int(batch.get("max_events", 50))
+            max_wait_ms = int(batch.get("max_wait_ms", 1000))
+        except Exception:
+            return jsonify({"status":"error","message":"batch.max_events & batch.max_wait_ms harus angka"}), 400
+        if not (1 < max_events <= WEBHOOK_BATCH_MAX_EVENTS) or not (0 < max_wait_ms <= WEBHOOK_BATCH_MAX_WAIT_MS):
+            return jsonify({"status":"error","message":f"batch.max_events 2..{WEBHOOK_BATCH_MAX_EVENTS}, batch.max_wait_ms 1..{WEBHOOK_BATCH_MAX_WAIT_MS}"}), 400
+        doc["batch_max_events"] = max_events
+        doc["batch_max_wait_ms"] = max_wait_ms
     ref = db.collection(WEBHOOKS_COL).add(doc)[1]
-    d = ref.get().to_dict(); d["id"] = ref.id
+    _sub_registry_put(ref.id, doc)
+    d = dict(doc); d["id"] = ref.id
     return jsonify({"status":"success","subscriber":d}), 201
 
 @app.route("/webhooks/unsubscribe", methods=["POST"])
@@ -780,11 +2788,13 @@ def webhooks_unsubscribe():
 
     if sub_id:
         db.collection(WEBHOOKS_COL).document(sub_id).update({"is_active": False, "updated_at": now_iso()})
+        _sub_registry_put(sub_id, None)
         return jsonify({"status":"success"}), 200
 
     snaps = db.collection(WEBHOOKS_COL).where("url","==",url).get()
     for s in snaps:
         db.collection(WEBHOOKS_COL).document(s.id).update({"is_active": False, "updated_at": now_iso()})
+        _sub_registry_put(s.id, None)
     return jsonify({"status":"success"}), 200
 
 # CONFIG_COLLECTION = "sys_config"
@@ -808,25 +2818,33 @@ def _direct_post_one(url, event):
         "X-Event-Type": event["type"],
         "X-Event-Id": event["id"],
     }
+    br = _breaker(url)
+    if not br.allow():
+        return False, CIRCUIT_OPEN
     try:
-        r = requests.post(url, data=body, headers=headers, timeout=POST_TIMEOUT_SECS)
-        return (200 <= r.status_code < 300), f"{r.status_code} {r.text[:200]}"
+        with _host_slot(url):
+            r = _http.post(url, data=body, headers=headers, timeout=POST_TIMEOUT_SECS)
+        ok = (200 <= r.status_code < 300)
+        br.record(ok)
+        return ok, f"{r.status_code} {r.text[:200]}"
     except Exception as e:
+        br.record(False)
         return False, str(e)
 
-def _direct_broadcast(event: dict):
+def _direct_broadcast(event: dict, shipment: dict = None):
     data = event.get("data", {})
     no_resi = data.get("no_resi", "?")
     new_status = data.get("new_status", "?")
     status_now = data.get("status_now", "?")
 
-    doc_id = data.get("doc_id")
-    doc = db.collection(COL_SHIPMENTS).document(doc_id).get()
-    if not doc.exists:
-        app.logger.warning(f"[Direct] doc_id {doc_id} tidak ditemukan di Firestore.")
-        return
+    if shipment is None:
+        doc_id = data.get("doc_id")
+        doc = db.collection(COL_SHIPMENTS).document(doc_id).get()
+        if not doc.exists:
+            app.logger.warning(f"[Direct] doc_id {doc_id} tidak ditemukan di Firestore.")
+            return
+        shipment = doc.to_dict()
 
-    shipment = doc.to_dict()
     id_retail = shipment.get("id_retail")
 
     target_url = RETAIL_ENDPOINTS.get(id_retail)
@@ -845,14 +2863,102 @@ def _direct_broadcast(event: dict):
             )
             break
         last_err = info
+        if info == CIRCUIT_OPEN:
+            break
         time.sleep((BACKOFF_BASE * (2 ** i)) + (0.05 * i))
     if not success:
         app.logger.error(f"[Direct ❌] Failed POST {target_url}: {last_err}")
-
-
-def _direct_broadcast_async(event):
-    th = threading.Thread(target=_direct_broadcast, args=(event,), daemon=True)
-    th.start()
+        try:
+            _enqueue_dlq(sub_id=f"retail-{id_retail}", url=target_url, event=event, last_err=last_err, channel="direct")
+        except Exception as e:
+            app.logger.warning(f"[Direct] gagal menulis DLQ: {e}")
+
+
+_direct_queue = queue.Queue(maxsize=DIRECT_QUEUE_MAX)
+# Antrean berisi kunci (no_resi bila coalescing aktif); event-nya di _direct_pending sehingga
+# event baru untuk resi yang masih antre cukup digabung ke entri yang sama.
+_direct_pending = {}
+_direct_stop = threading.Event()
+_direct_state = {"workers": [], "active": 0, "processed": 0, "coalesced": 0, "errors": 0, "rejected": 0}
+_direct_state_lock = threading.Lock()
+
+def _direct_worker():
+    while True:
+        key = _direct_queue.get()
+        try:
+            if key is None:
+                return
+            with _direct_state_lock:
+                due = _direct_pending[key][2]
+            delay = due - time.monotonic()
+            if delay > 0:
+                _direct_stop.wait(delay)
+            with _direct_state_lock:
+                event, shipment, _ = _direct_pending.pop(key)
+                _direct_state["active"] += 1
+            try:
+                _direct_broadcast(event, shipment)
+                _direct_state["processed"] += 1
+            except Exception as e:
+                _direct_state["errors"] += 1
+                app.logger.warning(f"[Direct] worker gagal: {e}")
+            finally:
+                with _direct_state_lock:
+                    _direct_state["active"] -= 1
+        finally:
+            _direct_queue.task_done()
+
+def _direct_start():
+    if _direct_state["workers"]:
+        return
+    for i in range(DIRECT_WORKERS):
+        th = threading.Thread(target=_direct_worker, name=f"direct-{i}", daemon=True)
+        th.start()
+        _direct_state["workers"].append(th)
+    atexit.register(_direct_shutdown)
+
+def _direct_shutdown():
+    # sentinel di belakang antrean: event yang sudah masuk tetap dikirim dulu (tanpa menunggu jendela)
+    _direct_stop.set()
+    for _ in _direct_state["workers"]:
+        _direct_queue.put(None)
+    for th in _direct_state["workers"]:
+        th.join(timeout=MAX_RETRIES * (POST_TIMEOUT_SECS + 1))
+    _direct_state["workers"] = []
+
+def _direct_broadcast_async(event, shipment: dict = None):
+    _direct_start()
+    key = (event.get("data") or {}).get("no_resi") if COALESCE_WINDOW_SECS > 0 else None
+    key = key or event.get("id")
+    with _direct_state_lock:
+        job = _direct_pending.get(key)
+        if job is not None:
+            job[0] = _coalesce_events(job[0], event)
+            job[1] = shipment if shipment is not None else job[1]
+            _direct_state["coalesced"] += 1
+            return
+        _direct_pending[key] = [event, shipment, time.monotonic() + COALESCE_WINDOW_SECS]
+    try:
+        # backpressure: producer menunggu sebentar bila antrean penuh
+        _direct_queue.put(key, timeout=DIRECT_ENQUEUE_TIMEOUT_SECS)
+    except queue.Full:
+        with _direct_state_lock:
+            _direct_pending.pop(key, None)
+        _direct_state["rejected"] += 1
+        app.logger.error(f"[Direct] antrean penuh, event {event.get('id')} tidak dikirim.")
+        raise
+
+def _direct_stats() -> dict:
+    return {
+        "workers": len(_direct_state["workers"]),
+        "active": _direct_state["active"],
+        "queue_depth": _direct_queue.qsize(),
+        "queue_max": DIRECT_QUEUE_MAX,
+        "processed": _direct_state["processed"],
+        "coalesced": _direct_state["coalesced"],
+        "errors": _direct_state["errors"],
+        "rejected": _direct_state["rejected"],
+    }
 
 @app.route("/api/broadcast-test", methods=["POST"])
 def api_broadcast_test():
@@ -875,7 +2981,10 @@ def api_broadcast_test():
     if not target_url:
         return jsonify({"status": "error", "message": f"id_retail {id_retail} tidak memiliki endpoint terdaftar."}), 404
 
-    _direct_broadcast_async(event)
+    try:
+        _direct_broadcast_async(event, d)
+    except queue.Full:
+        return jsonify({"status": "error", "message": "antrean broadcast penuh, coba lagi."}), 503
 
     return jsonify({
         "status": "success",
@@ -892,9 +3001,50 @@ def health():
     return jsonify({
         "ok": True,
         "time": now_iso(),
-        "retail_endpoints": RETAIL_ENDPOINTS  
+        "retail_endpoints": RETAIL_ENDPOINTS,
+        "route_cache": _route_cache_stats(),
+        "route_negative_cache": _neg_route_cache_stats(),
+        "status_cache": _status_cache_report(),
+        "webhook_outbox": _outbox_stats(),
+        "webhook_subscribers": _sub_registry_stats(),
+        "circuit_breakers": _breaker_stats(),
+        "direct_broadcast": _direct_stats(),
+        "archive_job": _archive_stats(),
+        "shipment_view": _shipment_view_stats(),
+        "event_stream": _event_hub.snapshot(),
     }), 200
 
+def _negotiate_encoding():
+    offers = (["br"] if brotli is not None else []) + ["gzip"]
+    enc = request.accept_encodings.best_match(offers)
+    return enc if enc and request.accept_encodings[enc] > 0 else None
+
+@app.after_request
+def _compress_response(resp):
+    """Kompres respons JSON non-stream di atas COMPRESS_MIN_BYTES (br bila tersedia, lalu gzip)."""
+    if resp.mimetype not in COMPRESS_MIMETYPES:
+        return resp
+    resp.vary.add("Accept-Encoding")
+    if (resp.status_code < 200 or resp.status_code in (204, 206, 304) or resp.is_streamed
+            or resp.direct_passthrough or "Content-Encoding" in resp.headers):
+        return resp
+    enc = _negotiate_encoding()
+    if enc is None:
+        return resp
+    body = resp.get_data()
+    if len(body) < COMPRESS_MIN_BYTES:
+        return resp
+    if enc == "br":
+        data = brotli.compress(body, quality=min(COMPRESS_LEVEL, 11))
+    else:
+        data = gzip.compress(body, compresslevel=COMPRESS_LEVEL, mtime=0)
+    resp.set_data(data)
+    resp.headers["Content-Encoding"] = enc
+    etag, weak = resp.get_etag()
+    if etag:
+        resp.set_etag(f"{etag}{ETAG_ENCODING_SEP}{enc}", weak=weak)
+    return resp
+
 EXCEL_PATH = os.path.join(os.path.dirname(__file__), "auth.xlsx")
 _auth_cache = {"mtime": None, "rows": [], "name_col": None, "pass_col": None}
 
@@ -939,14 +3089,6 @@ def verify_excel_credentials(name: str, password: str) -> bool:
     p = (password or "").strip()
     return any(n == nm and p == pw for nm, pw in _load_rows())
 
-def admin_required(fn):
-    @wraps(fn)
-    def _wrap(*args, **kwargs):
-        if not session.get("is_admin"):
-            return redirect(url_for("login_page"))
-        return fn(*args, **kwargs)
-    return _wrap
-
 @app.route("/login", methods=["GET"])
 def login_page():
     if session.get("is_admin"):
@@ -976,6 +3118,158 @@ def logout():
     session.clear()
     return redirect(url_for("login_page"))
 
+class _TokenBucket:
+    """Token bucket sederhana per target: `rate` token/detik, kapasitas `burst`."""
+
+    def __init__(self, rate: float, burst: float = None):
+        if not rate > 0:
+            raise ValueError("rate harus > 0.")
+        self.rate = float(rate)
+        self.capacity = float(burst if burst is not None else max(rate, 1.0))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+def replay_dlq(subscriber_id: str = None, target_url: str = None, parallelism: int = 8,
+               rate_per_sec: float = 5.0, limit: int = None, page_size: int = 200) -> dict:
+    """Kirim ulang entri webhook_deadletter (retryable) per halaman, paralel dengan
+    rate limit per target URL. Yang berhasil dihapus, yang gagal di-update (batched)."""
+    if not rate_per_sec > 0:
+        raise ValueError("rate_per_sec harus > 0.")
+    started = time.monotonic()
+    buckets = {}
+    report = {"scanned": 0, "delivered": 0, "failed": 0, "skipped": 0, "remaining_failures": []}
+
+    def _send(snap):
+        d = snap.to_dict() or {}
+        url = d.get("target_url")
+        if not url or not d.get("event"):
+            return snap, None, "entri tidak lengkap"
+        if d.get("channel") == "direct":
+            buckets[url].acquire()
+            return (snap,) + _direct_post_one(url, d["event"])
+        sub = _sub_registry["by_id"].get(d.get("subscriber_id"))
+        if sub is None:
+            return snap, None, "subscriber tidak aktif"
+        buckets[url].acquire()
+        event = [d["event"]] if sub.get("batch_max_events") else d["event"]
+        return (snap,) + _dispatch_one(url, sub.get("secret", ""), event, sub["mac"])
+
+    q = db.collection(DLQ_COL).where("retryable", "==", True)
+    if subscriber_id:
+        q = q.where("subscriber_id", "==", subscriber_id)
+    if target_url:
+        q = q.where("target_url", "==", target_url)
+    q = q.order_by("created_at")
+
+    _load_active_subscribers(EVENT_STATUS_UPDATED)  # pastikan registry segar
+    cursor = None
+    with ThreadPoolExecutor(max_workers=max(1, parallelism), thread_name_prefix="dlq-replay") as pool:
+        while limit is None or report["scanned"] < limit:
+            n = page_size if limit is None else min(page_size, limit - report["scanned"])
+            page_q = q.start_after(cursor) if cursor is not None else q
+            page = list(page_q.limit(n).stream())
+            if not page:
+                break
+            cursor = page[-1]
+            report["scanned"] += len(page)
+            for s in page:
+                url = s.get("target_url")
+                if url and url not in buckets:
+                    buckets[url] = _TokenBucket(rate_per_sec)
+
+            groups = []
+            for snap, ok, info in pool.map(_send, page):
+                if ok is None:
+                    report["skipped"] += 1
+                    continue
+                if ok:
+                    report["delivered"] += 1
+                    groups.append([("delete", snap.reference, None)])
+                    continue
+                report["failed"] += 1
+                groups.append([("update", snap.reference, {
+                    "last_error": info,
+                    "replay_attempts": int(snap.get("replay_attempts") or 0) + 1,
+                    "last_replay_at": now_iso(),
+                })])
+                if len(report["remaining_failures"]) < 50:
+                    report["remaining_failures"].append(
+                        {"id": snap.id, "target_url": snap.get("target_url"), "last_error": info})
+            _commit_batched(groups)
+            if len(page) < n:
+                break
+
+    elapsed = time.monotonic() - started
+    report["elapsed_secs"] = round(elapsed, 2)
+    report["throughput_per_sec"] = round(report["delivered"] / elapsed, 2) if elapsed > 0 else None
+    return report
+
+# Replay dari endpoint admin berjalan di thread latar (bisa ribuan entri, melebihi timeout
+# worker/proxy); status job dipantau lewat GET .../replay/<job_id>. Satu job aktif sekaligus.
+DLQ_JOBS_KEEP = 20
+_dlq_jobs = OrderedDict()
+_dlq_jobs_lock = threading.Lock()
+
+def _dlq_job_run(job_id: str, params: dict):
+    try:
+        report = replay_dlq(**params)
+        update = {"state": "done", "report": report}
+    except Exception as e:
+        app.logger.exception(f"[DLQ] replay job {job_id} gagal: {e}")
+        update = {"state": "error", "error": str(e)}
+    with _dlq_jobs_lock:
+        _dlq_jobs[job_id].update(update, finished_at=now_iso())
+
+@app.route("/admin/webhooks/dlq/replay", methods=["POST"])
+@admin_required
+def admin_replay_dlq():
+    data = request.get_json(silent=True) or request.form or {}
+    try:
+        params = dict(
+            subscriber_id=(data.get("subscriber_id") or "").strip() or None,
+            target_url=(data.get("target_url") or "").strip() or None,
+            parallelism=max(1, min(int(data.get("parallelism") or 8), WEBHOOK_MAX_CONCURRENCY)),
+            rate_per_sec=max(0.1, float(data.get("rate_per_sec") or 5)),
+            limit=max(1, min(int(data.get("limit") or 500), 5000)),
+        )
+    except ValueError:
+        return jsonify({"status": "error", "message": "parallelism/rate_per_sec/limit harus angka."}), 400
+
+    with _dlq_jobs_lock:
+        running = next((jid for jid, j in _dlq_jobs.items() if j["state"] == "running"), None)
+        if running:
+            return jsonify({"status": "error", "message": "Replay lain masih berjalan.", "job_id": running}), 409
+        job_id = f"dlqjob_{secrets.token_hex(6)}"
+        _dlq_jobs[job_id] = {"job_id": job_id, "state": "running", "params": params, "started_at": now_iso()}
+        while len(_dlq_jobs) > DLQ_JOBS_KEEP:
+            _dlq_jobs.popitem(last=False)
+    threading.Thread(target=_dlq_job_run, args=(job_id, params), name="dlq-replay-job", daemon=True).start()
+    return jsonify({"status": "accepted", "job_id": job_id,
+                    "status_url": url_for("admin_replay_dlq_status", job_id=job_id)}), 202
+
+@app.route("/admin/webhooks/dlq/replay/<job_id>", methods=["GET"])
+@admin_required
+def admin_replay_dlq_status(job_id):
+    with _dlq_jobs_lock:
+        job = _dlq_jobs.get(job_id)
+        job = dict(job) if job is not None else None
+    if job is None:
+        return jsonify({"status": "error", "message": "job tidak ditemukan."}), 404
+    return jsonify({"status": "success", "job": job}), 200
+
 def now_iso() -> str:
     return datetime.now(timezone.utc).isoformat()
 
@@ -990,29 +3284,6 @@ def gen_resi() -> str:
     rand = secrets.token_hex(3).upper()
     return f"RESI-{ts}-{rand[:6]}"
 
-def get_route_from_firestore(origin: str, destination: str):
-    o = (origin or "").strip().lower()
-    d = (destination or "").strip().lower()
-    doc = db.collection("routes").document(f"{o}_{d}").get()
-    if doc.exists:
-        return doc.to_dict()
-    q = db.collection("routes").where("origin", "==", o).where("destination", "==", d).get()
-    return q[0].to_dict() if q else None
-
-def route_info(asal: str, tujuan: str):
-    fs = get_route_from_firestore(asal, tujuan)
-    if fs:
-        return {
-            "price_base":       int(fs.get("price_base")),
-            "eta_days":         int(fs.get("eta_days", 1)),
-            "distributor_id":   int(fs.get("distributor_id", 2)),
-            "distributor_name": str(fs.get("distributor_name", "PT Ikan Terbang Makmur Sejahtera TBK")),
-            "per_kg_factor":    float(fs.get("per_kg_factor", 0.7)),
-            "included_kg":      int(fs.get("included_kg", 1)),
-        }
-    key = ((asal or "").strip().lower(), (tujuan or "").strip().lower())
-    return ROUTE_TABLE.get(key)
-
 def eta_text(days: int) -> str:
     return "1 hari" if days == 1 else f"{days} hari"
 
@@ -1024,144 +3295,309 @@ def calc_price(price_base: int, qty_kg: int, per_kg_factor: float = 0.7, include
     extra_cost = extra_kg * per_kg_factor * price_base
     return int(round(price_base + extra_cost))
 
-def _normalize_doc(d: dict) -> dict:
-    items = d.get("barang_dipesan") or []
-    first_name = (items[0].get("nama_barang") if items else None) or d.get("nama_barang") or "-"
-    qty = d.get("total_kuantitas") or d.get("kuantitas") or 0
-
-    eta_text = _first_non_empty(
-        d.get("eta_text"),
-        d.get("eta"),
-        d.get("estimasi_tiba"),
-    )
-    eta_days = _first_non_empty(
-        d.get("eta_days"),
-    )
-    eta_date_raw = _first_non_empty(
-        d.get("eta_delivery_date"),
-        d.get("eta_date"),
-    )
-    eta_delivery_date = _date_to_ymd_or_same(eta_date_raw)
-
-    normalized = {
-        "doc_id": d.get("doc_id"),
-        "no_resi": d.get("no_resi"),
-        "buyer": d.get("id_pembeli") or d.get("nama_supplier") or (d.get("id_retail") and f"RETAIL-{d.get('id_retail')}") or "-",
-        "item_name": first_name,
-        "qty": qty,
-        "route_origin": d.get("asal_pengirim") or d.get("asal_supplier") or "-",
-        "route_dest": d.get("tujuan") or d.get("tujuan_retail") or "-",
-        "price": d.get("harga_pengiriman") or d.get("biaya_pengiriman") or 0,
-        "status": d.get("status") or "-",
-        "tanggal_pembelian": d.get("tanggal_pembelian") or "-",
-        "created_at": d.get("created_at") or "-",
-
-        "eta_text": eta_text,
-        "eta_days": eta_days,
-        "eta_delivery_date": eta_delivery_date,
-    }
-
-    if items and len(items) > 0:
-        normalized["barang_dipesan"] = items
-        normalized["total_kuantitas"] = qty
-
-    return normalized
-
-def _hmac_signature(secret: str, body_bytes: bytes) -> str:
-    mac = hmac.new(secret.encode("utf-8"), body_bytes, hashlib.sha256)
-    return mac.hexdigest()
+# Export kolumnar (Parquet / Arrow IPC) untuk analitik offline. Kolom dan tipe tetap supaya
+# file antar-halaman dan antar-run bisa langsung digabung.
+EXPORT_COLUMNS = {
+    "collection": "string", "doc_id": "string", "no_resi": "string", "status": "string",
+    "route_origin": "string", "route_dest": "string", "buyer": "string", "id_retail": "Int64",
+    "distributor_id": "Int64", "distributor_name": "string", "item_name": "string", "qty": "Int64",
+    "price": "float64", "harga_dasar": "float64", "currency": "string", "eta_days": "Int64",
+    "tanggal_pembelian": "string", "created_at": "string", "updated_at": "string",
+}
+EXPORT_FORMATS = {"parquet": ".parquet", "arrow": ".arrow"}
 
-def _load_active_subscribers(event_name: str):
-    docs = db.collection(WEBHOOKS_COL).where("is_active", "==", True).stream()
-    subs = []
-    for d in docs:
-        obj = d.to_dict()
-        if event_name in (obj.get("events") or []):
-            obj["id"] = d.id
-            subs.append(obj)
-    return subs
-
-def _dispatch_one(url: str, secret: str, event: dict):
-    body = json.dumps(event, ensure_ascii=False).encode("utf-8")
-    sig  = _hmac_signature(secret or "", body)
-    headers = {
-        "Content-Type": "application/json",
-        "User-Agent": "distributor-webhook/1.0",
-        "X-Event-Type": event["type"],
-        "X-Event-Id": event["id"],
-        "X-Signature": sig,
-    }
+def _export_num(v, cast):
     try:
-        r = requests.post(url, data=body, headers=headers, timeout=POST_TIMEOUT_SECS)
-        ok = (200 <= r.status_code < 300)
-        return ok, f"{r.status_code} {r.text[:200]}"
-    except Exception as e:
-        return False, str(e)
-
-def _enqueue_dlq(sub_id: str, url: str, event: dict, last_err: str):
-    db.collection(DLQ_COL).add({
-        "subscriber_id": sub_id,
-        "target_url": url,
-        "event": event,
-        "last_error": last_err,
-        "created_at": now_iso(),
-        "retryable": True,
-    })
+        return cast(v) if v not in (None, "", "-") else None
+    except (TypeError, ValueError):
+        return None
 
-def _build_status_event(doc_after: dict, old_status: str, new_status: str) -> dict:
+def _export_row(col: str, doc_id: str, d: dict) -> dict:
+    n = _normalize_doc(dict(d, doc_id=d.get("doc_id") or doc_id))
     return {
-        "id": f"evt_{secrets.token_hex(8)}",
-        "type": EVENT_STATUS_UPDATED,
-        "created_at": now_iso(),
-        "version": 1,
-        "data": {
-            "no_resi": doc_after.get("no_resi"),
-            "doc_id": doc_after.get("doc_id"),
-            "old_status": old_status,
-            "new_status": new_status,
-            "route": {
-                "origin": doc_after.get("asal_pengirim") or doc_after.get("asal_supplier"),
-                "destination": doc_after.get("tujuan") or doc_after.get("tujuan_retail"),
-            },
-            "updated_at": now_iso(),
-        }
+        "collection": col, "doc_id": n["doc_id"], "no_resi": d.get("no_resi"), "status": n["status"],
+        "route_origin": n["route_origin"], "route_dest": n["route_dest"], "buyer": str(n["buyer"]),
+        "id_retail": _export_num(d.get("id_retail"), int),
+        "distributor_id": _export_num(d.get("distributor_id"), int),
+        "distributor_name": _canonical(d)["distributor_name"],
+        "item_name": n["item_name"], "qty": _export_num(n["qty"], int),
+        "price": _export_num(n["price"], float), "harga_dasar": _export_num(d.get("harga_dasar"), float),
+        "currency": d.get("currency", "IDR"), "eta_days": _export_num(n["eta_days"], int),
+        "tanggal_pembelian": str(n["tanggal_pembelian"]), "created_at": str(n["created_at"]),
+        "updated_at": d.get("updated_at"),
     }
 
-def _notify_status_change(doc_after: dict, old_status: str, new_status: str):
-    subs = _load_active_subscribers(EVENT_STATUS_UPDATED)
-    if not subs:
-        return
-    event = _build_status_event(doc_after, old_status, new_status)
-    for sub in subs:
-        url = sub.get("url"); secret = sub.get("secret","")
-        success = False; last_err = ""
-        for i in range(MAX_RETRIES):
-            ok, info = _dispatch_one(url, secret, event)
-            if ok:
-                success = True
-                break
-            last_err = info
-            time.sleep((BACKOFF_BASE * (2 ** i)) + (0.05 * i))
-        if not success:
-            _enqueue_dlq(sub_id=sub["id"], url=url, event=event, last_err=last_err)
-
-
-def _date_to_ymd_or_same(x):
+def _export_until() -> str:
+    return (datetime.now(timezone.utc) - timedelta(seconds=EXPORT_SAFETY_LAG_SECS)).isoformat()
+
+def _export_pages(col: str, since: str = None, until: str = None, skip_ids=()):
+    """Yield list baris per halaman (EXPORT_PAGE_SIZE) dengan since <= updated_at <= until.
+    Dokumen di `skip_ids` yang updated_at-nya tepat `since` (sudah ikut export sebelumnya) dilewati."""
+    q = db.collection(col)
+    if since:
+        q = q.where("updated_at", ">=", since)
+    if until:
+        q = q.where("updated_at", "<=", until)
+    q = q.order_by("updated_at").limit(EXPORT_PAGE_SIZE)
+    last = None
+    while True:
+        page = (q.start_after(last) if last is not None else q).get()
+        if not page:
+            return
+        rows = [_export_row(col, s.id, s.to_dict() or {}) for s in page
+                if not (s.id in skip_ids and s.get("updated_at") == since)]
+        if rows:
+            yield rows
+        if len(page) < EXPORT_PAGE_SIZE:
+            return
+        last = page[-1]
+
+def _export_frame(rows: list) -> "pd.DataFrame":
+    return pd.DataFrame.from_records(rows, columns=list(EXPORT_COLUMNS)).astype(EXPORT_COLUMNS)
+
+def _export_write(df: "pd.DataFrame", path: str, fmt: str):
+    if fmt == "parquet":
+        df.to_parquet(path, index=False, compression="zstd")
+    else:
+        df.to_feather(path)
 
-    if isinstance(x, dict) and "seconds" in x:
-        dt = datetime.fromtimestamp(int(x["seconds"]))
-        return dt.strftime("%Y-%m-%d")
-    if isinstance(x, datetime):
-        return x.strftime("%Y-%m-%d")
-    if isinstance(x, str):
-        try:
-            dt = datetime.fromisoformat(x.replace("Z", "+00:00")) if ("T" in x or "Z" in x or "+" in x) else datetime.strptime(x, "%Y-%m-%d")
-            return dt.strftime("%Y-%m-%d")
-        except Exception:
-            return x
-    return None
+def _export_watermarks(out_dir: str) -> dict:
+    try:
+        with open(os.path.join(out_dir, "_watermark.json"), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def export_shipments(out_dir: str = None, fmt: str = "parquet", scopes=("aktif", "history"),
+                     since: str = None, full: bool = False) -> dict:
+    """Export tb_pengiriman/tb_histori ke {out_dir}/{scope}/{YYYY-MM}/part-*.{parquet|arrow},
+    dipecah per bulan updated_at. Tanpa `since`/`full` hanya dokumen yang berubah sejak
+    watermark terakhir ({out_dir}/_watermark.json) yang diambil. Watermark menyimpan juga
+    doc_id yang updated_at-nya tepat di watermark, supaya run berikutnya (>=) tidak
+    mengulangnya. Memori ~ satu halaman."""
+    out_dir = out_dir or EXPORT_DIR
+    os.makedirs(out_dir, exist_ok=True)
+    marks = _export_watermarks(out_dir)
+    until = _export_until()
+    run_id = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
+    report = {"until": until, "scopes": {}}
+    for scope in scopes:
+        col = SHIPMENT_SCOPES[scope]
+        start = None if full else (since or marks.get(scope))
+        ids_key = f"{scope}:doc_ids"
+        high_ids = list(marks.get(ids_key) or []) if start and start == marks.get(scope) else []
+        rows_total, files, high = 0, [], start
+        for n, rows in enumerate(_export_pages(col, since=start, until=until, skip_ids=set(high_ids))):
+            by_month = {}
+            for r in rows:
+                by_month.setdefault(str(r["updated_at"])[:7], []).append(r)
+            for month, month_rows in by_month.items():
+                os.makedirs(os.path.join(out_dir, scope, month), exist_ok=True)
+                path = os.path.join(out_dir, scope, month, f"part-{run_id}-{n:05d}{EXPORT_FORMATS[fmt]}")
+                _export_write(_export_frame(month_rows), path, fmt)
+                files.append(os.path.relpath(path, out_dir))
+            rows_total += len(rows)
+            for r in rows:
+                if r["updated_at"] != high:
+                    high, high_ids = r["updated_at"], []
+                high_ids.append(r["doc_id"])
+        marks[scope] = high or until
+        marks[ids_key] = high_ids
+        with open(os.path.join(out_dir, "_watermark.json"), "w", encoding="utf-8") as f:
+            json.dump(marks, f, indent=2)
+        report["scopes"][scope] = {"since": start, "watermark": marks[scope], "rows": rows_total, "files": files}
+    return report
+
+@app.route("/api/export", methods=["GET"])
+@admin_required
+def api_export():
+    """Satu file Parquet/Arrow berisi dokumen dengan since <= updated_at <= sekarang - lag.
+    Ditulis per halaman ke file sementara; header X-Export-Watermark = `since` untuk run berikutnya.
+    Dokumen tepat di watermark ikut terkirim lagi; dedup per doc_id di sisi pemakai."""
+    scope = (request.args.get("collection") or "history").strip().lower()
+    fmt = (request.args.get("format") or "parquet").strip().lower()
+    since = (request.args.get("since") or "").strip() or None
+    if scope not in SHIPMENT_SCOPES:
+        return jsonify({"status": "error", "message": "collection harus aktif atau history."}), 400
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({"status": "error", "message": "format harus parquet atau arrow."}), 400
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        return jsonify({"status": "error", "message": "pyarrow belum terpasang di server."}), 501
+
+    until = _export_until()
+    tmp = tempfile.TemporaryFile()
+    writer, high, rows_total = None, since, 0
+    for rows in _export_pages(SHIPMENT_SCOPES[scope], since=since, until=until):
+        table = pa.Table.from_pandas(_export_frame(rows), preserve_index=False)
+        if writer is None:
+            writer = (pq.ParquetWriter(tmp, table.schema, compression="zstd") if fmt == "parquet"
+                      else pa.ipc.new_file(tmp, table.schema))
+        writer.write_table(table)
+        rows_total += len(rows)
+        high = rows[-1]["updated_at"]
+    if writer is None:
+        table = pa.Table.from_pandas(_export_frame([]), preserve_index=False)
+        writer = (pq.ParquetWriter(tmp, table.schema) if fmt == "parquet" else pa.ipc.new_file(tmp, table.schema))
+    writer.close()
+    tmp.seek(0)
+
+    resp = send_file(tmp, mimetype="application/vnd.apache.parquet" if fmt == "parquet" else "application/vnd.apache.arrow.file",
+                     as_attachment=True, download_name=f"{COL_SHIPMENTS if scope == 'aktif' else COL_HISTORY}-{until[:10]}{EXPORT_FORMATS[fmt]}")
+    resp.headers["X-Export-Watermark"] = high or until
+    resp.headers["X-Export-Rows"] = str(rows_total)
+    return resp
+
+@app.cli.command("export-shipments")
+@click.option("--out-dir", default=EXPORT_DIR, show_default=True)
+@click.option("--format", "fmt", type=click.Choice(list(EXPORT_FORMATS)), default="parquet", show_default=True)
+@click.option("--collection", "scope", type=click.Choice(["aktif", "history", "all"]), default="all", show_default=True)
+@click.option("--since", default=None, help="ISO updated_at; default = watermark export terakhir.")
+@click.option("--full", is_flag=True, help="Abaikan watermark, export semuanya.")
+def export_shipments_cmd(out_dir, fmt, scope, since, full):
+    """Export kolumnar tb_pengiriman/tb_histori per bulan (incremental via watermark updated_at)."""
+    scopes = ("aktif", "history") if scope == "all" else (scope,)
+    print(json.dumps(export_shipments(out_dir=out_dir, fmt=fmt, scopes=scopes, since=since, full=full), indent=2))
+
+@app.cli.command("replay-dlq")
+@click.option("--subscriber-id", default=None, help="Hanya entri untuk subscriber ini.")
+@click.option("--url", "target_url", default=None, help="Hanya entri untuk target URL ini.")
+@click.option("--parallelism", default=8, show_default=True, type=click.IntRange(min=1))
+@click.option("--rate", "rate_per_sec", default=5.0, show_default=True, type=click.FloatRange(min=0, min_open=True),
+              help="Request/detik per target.")
+@click.option("--limit", default=None, type=int, help="Maksimal entri yang diproses.")
+def replay_dlq_command(subscriber_id, target_url, parallelism, rate_per_sec, limit):
+    """Kirim ulang event di webhook_deadletter."""
+    report = replay_dlq(subscriber_id=subscriber_id, target_url=target_url,
+                        parallelism=parallelism, rate_per_sec=rate_per_sec, limit=limit)
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+@app.cli.command("backfill-resi-index")
+def backfill_resi_index():
+    """Isi resi_index dari tb_pengiriman dan tb_histori yang sudah ada."""
+    total = 0
+    for col in (COL_HISTORY, COL_SHIPMENTS):
+        groups = [[("set", *_resi_index_entry(s.get("no_resi"), col, s.id))]
+                  for s in db.collection(col).stream() if s.get("no_resi")]
+        errors = _commit_batched(groups)
+        failed = sum(1 for e in errors if e)
+        total += len(groups) - failed
+        print(f"[backfill-resi-index] {col}: {len(groups) - failed} ditulis, {failed} gagal")
+    print(f"[backfill-resi-index] selesai, {total} resi terindeks")
+
+@app.cli.command("rebuild-analytics")
+def rebuild_analytics():
+    """Hitung ulang rollup tb_analytics dari tb_pengiriman, tb_histori dan tb_histori_summary.
+    Jalankan saat traffic sepi: increment yang masuk selama rebuild bisa hilang."""
+    total = {}
+    for col in (COL_SHIPMENTS, COL_HISTORY):
+        for s in db.collection(col).stream():
+            d = s.to_dict() or {}
+            _deep_add(total, _analytics_created_delta(d))
+            day = _purchase_day(d)
+            if d.get("status") == STATUS_LIST[-1] and day:
+                _deep_add(total, {"completed_by_month": {day[:7]: 1}})
+    for s in db.collection(COL_HISTORY_SUMMARY).stream():
+        _deep_add(total, (s.to_dict() or {}).get("rollup") or {})
+    for s in db.collection(COL_ANALYTICS).stream():
+        s.reference.delete()
+    db.collection(COL_ANALYTICS).document("shard_0").set(total)
+    print(f"[rebuild-analytics] {int(total.get('total', 0))} shipment dirangkum")
+
+@app.cli.command("backfill-schema")
+def backfill_schema():
+    """Tandai dokumen lama dengan field `schema`, simpan eta_delivery_date sebagai YYYY-MM-DD
+    (jalur proyeksi cepat) dan isi route_origin/route_dest untuk filter rute."""
+    for col in (COL_SHIPMENTS, COL_HISTORY):
+        groups, mixed = [], 0
+        for s in db.collection(col).stream():
+            d = s.to_dict() or {}
+            patch = {}
+            if "route_origin" not in d or "route_dest" not in d:
+                # filter rute /api/shipments hanya melihat dokumen yang punya field ini
+                c = _canonical(d)
+                patch["route_origin"], patch["route_dest"] = _route_key(c["origin"], c["dest"])
+            if not d.get("schema"):
+                schema = _detect_schema(d)
+                if schema is None:
+                    mixed += 1
+                else:
+                    patch["schema"] = schema
+                    eta = _date_to_ymd_or_same(d.get("eta_delivery_date"))
+                    if eta is not None and eta != d.get("eta_delivery_date"):
+                        patch["eta_delivery_date"] = eta
+            if patch:
+                groups.append([("update", s.reference, patch)])
+        errors = _commit_batched(groups)
+        failed = sum(1 for e in errors if e)
+        print(f"[backfill-schema] {col}: {len(groups) - failed} diperbarui, {failed} gagal, {mixed} campuran (fallback)")
+
+@app.cli.command("bench-normalize")
+@click.option("--n", "count", default=100_000, show_default=True, type=int)
+def bench_normalize(count):
+    """Micro-benchmark biaya _normalize_doc per dokumen (tanpa Firestore)."""
+    base = {
+        SCHEMA_SHIPMENTS: {"doc_id": "PG-1", "no_resi": "RESI-1", "id_pembeli": "B-1", "nama_barang": "Ikan",
+                           "kuantitas": 3, "asal_pengirim": "malang", "tujuan": "surabaya", "harga_pengiriman": 25000,
+                           "distributor_name": "PT X", "eta_days": 1, "eta_text": "1 hari",
+                           "eta_delivery_date": "2025-01-08", "status": STATUS_LIST[0],
+                           "tanggal_pembelian": "2025-01-07", "created_at": "2025-01-07T10:00:00+00:00"},
+        SCHEMA_PENGIRIMAN: {"doc_id": "PG-2", "no_resi": "RESI-2", "id_retail": 1, "nama_supplier": "S",
+                            "barang_dipesan": [{"nama_barang": "Ikan", "kuantitas": 3}], "total_kuantitas": 3,
+                            "asal_supplier": "malang", "tujuan_retail": "surabaya", "biaya_pengiriman": 25000,
+                            "nama_distributor": "PT X", "eta_days": 1, "eta_text": "1 hari",
+                            "eta_delivery_date": "2025-01-08", "status": STATUS_LIST[0],
+                            "tanggal_pembelian": "2025-01-07", "created_at": "2025-01-07T10:00:00+00:00"},
+    }
+    cases = {
+        "schema tersimpan": [dict(base[s], schema=s) for s in base],
+        "deteksi schema": list(base.values()),
+        "fallback (campuran)": [dict(base[SCHEMA_SHIPMENTS], eta="1 hari", eta_delivery_date="2025-01-08T00:00:00Z")],
+    }
+    for name, docs in cases.items():
+        docs = (docs * (count // len(docs) + 1))[:count]
+        started = time.perf_counter()
+        for d in docs:
+            _normalize_doc(d)
+        elapsed = time.perf_counter() - started
+        print(f"{name:22s} {count} dok  {elapsed:.3f}s  {elapsed / count * 1e6:.2f} us/dok")
+
+@app.cli.command("archive-completed")
+@click.option("--limit", default=None, type=int, help="Maks. pesanan yang dipindah.")
+def archive_completed_cmd(limit):
+    """Pindahkan pesanan selesai yang tertinggal di tb_pengiriman ke tb_histori."""
+    print(json.dumps(archive_completed(limit=limit), indent=2))
+
+@app.cli.command("compact-history")
+@click.option("--older-than-days", default=HISTORY_COMPACT_AFTER_DAYS, show_default=True, type=int)
+@click.option("--out-dir", default=ARCHIVE_DIR, show_default=True)
+def compact_history_cmd(older_than_days, out_dir):
+    """Pindahkan tb_histori lama ke file NDJSON.gz per bulan + tb_histori_summary."""
+    print(json.dumps(compact_history(older_than_days=older_than_days, out_dir=out_dir), indent=2))
+
+_background = {"started": False}
+_background_lock = threading.Lock()
+
+def start_background():
+    """Listener + thread latar (route cache, registry subscriber, outbox, direct broadcast, arsip,
+    shipment view). Sekali per proses server; sengaja tidak jalan saat import (perintah CLI)."""
+    with _background_lock:
+        if _background["started"]:
+            return
+        _background["started"] = True
+    _route_cache_start()
+    _sub_registry_start()
+    _outbox_start()
+    _direct_start()
+    _archive_start()
+    _shipment_view_start()
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", "5000"))
-    app.logger.info(f"[Startup] Retail endpoints: {json.dumps(RETAIL_ENDPOINTS, indent=2)}")
+    # debug=True memakai reloader: hanya proses anak (WERKZEUG_RUN_MAIN) yang melayani request
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        app.logger.info(f"[Startup] Retail endpoints: {json.dumps(RETAIL_ENDPOINTS, indent=2)}")
+        start_background()
     app.run(host="0.0.0.0", port=port, debug=True)
\ No newline at end of file
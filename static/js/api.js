@@ -18,6 +18,23 @@ const API = {
         }
     },
 
+    // GET one page of shipments (collection: 'aktif' | 'history')
+    async getShipmentsPage(collection, params = {}) {
+        try {
+            const query = new URLSearchParams({ collection });
+            Object.entries(params).forEach(([key, value]) => {
+                if (value !== undefined && value !== null && value !== '') query.append(key, value);
+            });
+            const response = await fetch(`${this.baseURL}/api/shipments?${query.toString()}`);
+            if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
+            const data = await response.json();
+            return { success: true, data: data };
+        } catch (error) {
+            console.error('Error fetching shipments page:', error);
+            return { success: false, error: error.message };
+        }
+    },
+
     // GET status by resi
     async getStatusByResi(resiNumber) {
         try {
@@ -70,64 +87,45 @@ const API = {
         }
     },
 
-    // Helper: Group by month
-    groupByMonth(shipments, monthsBack = 6) {
-        const now = new Date();
-        const months = [];
-        const monthNames = ['Jan', 'Feb', 'Mar', 'Apr', 'Mei', 'Jun', 'Jul', 'Agu', 'Sep', 'Okt', 'Nov', 'Des'];
-        
-        for (let i = monthsBack - 1; i >= 0; i--) {
-            const d = new Date(now.getFullYear(), now.getMonth() - i, 1);
-            months.push({
-                year: d.getFullYear(),
-                month: d.getMonth(),
-                label: monthNames[d.getMonth()],
-                count: 0
+    // POST update status banyak pesanan sekaligus
+    async bulkUpdateStatus(docIds, newStatus) {
+        try {
+            const response = await fetch(`${this.baseURL}/api/status/bulk-update`, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ doc_ids: docIds, status: newStatus })
             });
+            const data = await response.json();
+            if (!response.ok) throw new Error(data.message || 'Gagal mengupdate status');
+            return { success: true, data: data };
+        } catch (error) {
+            return { success: false, error: error.message };
+        }
+    },
+
+    // GET pre-aggregated analytics (rollup di server)
+    async getAnalytics(months = 6) {
+        try {
+            const response = await fetch(`${this.baseURL}/api/analytics?months=${months}`);
+            if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
+            const data = await response.json();
+            return { success: true, data: data };
+        } catch (error) {
+            console.error('Error fetching analytics:', error);
+            return { success: false, error: error.message };
         }
-        
-        shipments.forEach(item => {
-            const dateStr = item.tanggal_pembelian || item.created_at;
-            if (!dateStr) return;
-            const date = new Date(dateStr);
-            if (isNaN(date.getTime())) return;
-            
-            const month = months.find(m => m.month === date.getMonth() && m.year === date.getFullYear());
-            if (month) month.count++;
-        });
-        
-        return months;
     },
 
-    // Helper: Calculate stats
-    calculateStats(aktif, history) {
-        const total = aktif.length + history.length;
-        
-        // Count exact status dari backend
-        const proses = aktif.filter(x => x.status === "Pesanan anda sedang kami proses").length;
-        const kirim = aktif.filter(x => {
-            const s = x.status || '';
-            return s.includes('Kurir') || s.includes('Gudang') || s.includes('lokasi');
-        }).length;
-        const selesai = history.length;
-        
-        // Growth calculation
-        const now = new Date();
-        const weekAgo = new Date(now.getTime() - 7 * 24 * 60 * 60 * 1000);
-        const allShipments = [...aktif, ...history];
-        
-        const thisWeek = allShipments.filter(item => {
-            const dateStr = item.tanggal_pembelian || item.created_at;
-            if (!dateStr) return false;
-            const date = new Date(dateStr);
-            return date >= weekAgo;
-        }).length;
-        
-        const lastWeek = allShipments.length - thisWeek;
-        const growth = lastWeek > 0 ? Math.round(((thisWeek - lastWeek) / lastWeek) * 100) : (thisWeek > 0 ? 100 : 0);
-        const completionRate = total > 0 ? Math.round((selesai / total) * 100) : 0;
-        
-        return { total, proses, kirim, selesai, growth, completionRate };
+    // Helper: Stats untuk kartu dashboard dari /api/analytics
+    statsFromAnalytics(analytics) {
+        return {
+            total: analytics.total || 0,
+            proses: analytics.proses || 0,
+            kirim: analytics.kirim || 0,
+            selesai: analytics.selesai || 0,
+            growth: analytics.growth || 0,
+            completionRate: analytics.completion_rate || 0
+        };
     }
 };
 
@@ -6,6 +6,16 @@ let allShipmentsData = { aktif: [], history: [] };
 let filteredAktifData = [];
 let filteredSelesaiData = [];
 
+// Paging state tabel Kelola Pesanan (cursor dari /api/shipments)
+const PAGE_SIZE = 50;
+const pageState = {
+  aktif: { nextCursor: null, hasMore: false },
+  history: { nextCursor: null, hasMore: false },
+};
+
+// Pesanan aktif yang dicentang untuk update status massal
+const selectedAktif = new Set();
+
 // Analytics Charts
 let revenueChartInstance = null;
 let statusChartInstance = null;
@@ -53,8 +63,30 @@ document.addEventListener("DOMContentLoaded", () => {
 
   setupSearchAndFilters();
   loadDashboard();
+  watchStatusUpdates();
 });
 
+// ============ LIVE STATUS (SSE) ============
+// Terapkan event shipment.status.updated ke tabel aktif tanpa memuat ulang halaman.
+function watchStatusUpdates() {
+  if (!window.EventSource) return;
+  const source = new EventSource("/api/events/stream");
+  source.addEventListener("shipment.status.updated", (e) => {
+    const data = JSON.parse(e.data).data || {};
+    const idx = allShipmentsData.aktif.findIndex((s) => s.no_resi === data.no_resi);
+    if (idx === -1) return;
+    if (data.new_status === "Pesanan Selesai") {
+      allShipmentsData.aktif.splice(idx, 1);
+    } else {
+      allShipmentsData.aktif[idx] = { ...allShipmentsData.aktif[idx], status: data.new_status };
+    }
+    filterAktifData(
+      document.getElementById("search-aktif")?.value || "",
+      document.getElementById("filter-status-aktif")?.value || ""
+    );
+  });
+}
+
 // ============ SEARCH & FILTER SETUP ============
 function setupSearchAndFilters() {
   const searchAktif = document.getElementById("search-aktif");
@@ -69,14 +101,20 @@ function setupSearchAndFilters() {
 
   const filterStatusAktif = document.getElementById("filter-status-aktif");
   if (filterStatusAktif) {
-    filterStatusAktif.addEventListener("change", (e) => {
-      filterAktifData(
-        document.getElementById("search-aktif")?.value || "",
-        e.target.value
-      );
+    // Filter status dijalankan di server, lalu paging mulai dari awal
+    filterStatusAktif.addEventListener("change", async () => {
+      allShipmentsData.aktif = [];
+      await loadShipmentsPage("aktif");
     });
   }
 
+  document
+    .getElementById("load-more-aktif")
+    ?.addEventListener("click", () => loadShipmentsPage("aktif", true));
+  document
+    .getElementById("load-more-selesai")
+    ?.addEventListener("click", () => loadShipmentsPage("history", true));
+
   const searchSelesai = document.getElementById("search-selesai");
   if (searchSelesai) {
     searchSelesai.addEventListener("input", (e) => {
@@ -134,23 +172,20 @@ function filterSelesaiData(searchText) {
 // ============ DASHBOARD ============
 async function loadDashboard() {
   try {
-    const result = await API.getShipments();
-    if (!result.success) throw new Error(result.error);
-
-    const aktif = result.data.aktif || [];
-    const history = result.data.history || [];
-
-    allShipmentsData = { aktif, history };
-
-    const stats = API.calculateStats(aktif, history);
+    const [analyticsResult, recentResult] = await Promise.all([
+      API.getAnalytics(6),
+      API.getShipmentsPage("aktif", { limit: 10 }),
+    ]);
+    if (!analyticsResult.success) throw new Error(analyticsResult.error);
+    if (!recentResult.success) throw new Error(recentResult.error);
+
+    const stats = API.statsFromAnalytics(analyticsResult.data);
     ChartManager.animateStats(stats);
     ChartManager.updateStatChanges(stats);
 
-    const allShipments = [...aktif, ...history];
-    const months = API.groupByMonth(allShipments, 6);
-    ChartManager.initShipmentChart(months);
+    ChartManager.initShipmentChart(analyticsResult.data.monthly || []);
 
-    updateRecentOrdersTable(aktif.slice(0, 10));
+    updateRecentOrdersTable(recentResult.data.items || []);
   } catch (error) {
     console.error("Error loading dashboard:", error);
     utils.showToast("Gagal memuat dashboard", "error");
@@ -204,27 +239,62 @@ document.querySelectorAll(".sub-tab-item").forEach((item) => {
 
 async function loadKelolaPesanan() {
   try {
-    const result = await API.getShipments();
-    if (!result.success) throw new Error(result.error);
-
-    allShipmentsData = {
-      aktif: result.data.aktif || [],
-      history: result.data.history || [],
-    };
-    filteredAktifData = [...allShipmentsData.aktif];
-    filteredSelesaiData = [...allShipmentsData.history];
-
     populateStatusFilter();
-    updateAktifTable(filteredAktifData);
-    updateSelesaiTable(filteredSelesaiData);
+    allShipmentsData = { aktif: [], history: [] };
+    await Promise.all([loadShipmentsPage("aktif"), loadShipmentsPage("history")]);
   } catch (error) {
     utils.showToast("Gagal memuat data pesanan", "error");
   }
 }
 
+async function loadShipmentsPage(collection, append = false) {
+  const state = pageState[collection];
+  const params = { limit: PAGE_SIZE };
+  if (append && state.nextCursor) params.cursor = state.nextCursor;
+  if (collection === "aktif") {
+    params.status = document.getElementById("filter-status-aktif")?.value || "";
+  }
+
+  const result = await API.getShipmentsPage(collection, params);
+  if (!result.success) {
+    utils.showToast("Gagal memuat data pesanan", "error");
+    return;
+  }
+
+  const items = result.data.items || [];
+  allShipmentsData[collection] = append
+    ? [...allShipmentsData[collection], ...items]
+    : items;
+  state.nextCursor = result.data.next_cursor;
+  state.hasMore = !!result.data.has_more;
+
+  if (collection === "aktif") {
+    filterAktifData(document.getElementById("search-aktif")?.value || "", "");
+    toggleLoadMore("load-more-aktif", state.hasMore);
+  } else {
+    filterSelesaiData(document.getElementById("search-selesai")?.value || "");
+    toggleLoadMore("load-more-selesai", state.hasMore);
+  }
+}
+
+function toggleLoadMore(id, visible) {
+  const btn = document.getElementById(id);
+  if (btn) btn.style.display = visible ? "" : "none";
+}
+
 function populateStatusFilter() {
+  const bulkSelect = document.getElementById("bulk-status");
+  if (bulkSelect && bulkSelect.options.length <= 1) {
+    utils.STATUS_LIST.forEach((status) => {
+      const option = document.createElement("option");
+      option.value = status;
+      option.textContent = status;
+      bulkSelect.appendChild(option);
+    });
+  }
+
   const filterSelect = document.getElementById("filter-status-aktif");
-  if (!filterSelect) return;
+  if (!filterSelect || filterSelect.options.length > 1) return;
 
   filterSelect.innerHTML = '<option value="">Semua Status</option>';
 
@@ -241,8 +311,14 @@ function updateAktifTable(orders) {
   if (!tbody) return;
 
   tbody.innerHTML = "";
+  // re-render (filter, SSE) tidak menghapus pilihan; hanya buang id yang sudah tidak ada di data aktif
+  const aktifIds = new Set(allShipmentsData.aktif.map((o) => o.doc_id));
+  [...selectedAktif].forEach((id) => {
+    if (!aktifIds.has(id)) selectedAktif.delete(id);
+  });
+  updateBulkSelection();
   if (orders.length === 0) {
-    tbody.innerHTML = `<tr><td colspan="10" class="text-center">
+    tbody.innerHTML = `<tr><td colspan="11" class="text-center">
             <div class="empty-state"><i class="fas fa-box-open"></i><h3>Tidak ada pesanan ditemukan</h3></div>
         </td></tr>`;
     return;
@@ -321,6 +397,7 @@ function updateAktifTable(orders) {
     // [REV] ===== END ETA DISPLAY =====
 
     tr.innerHTML = `
+            <td><input type="checkbox" class="select-aktif" value="${order.doc_id}" ${selectedAktif.has(order.doc_id) ? "checked" : ""} /></td>
             <td>${index + 1}</td>
             <td><strong>${order.no_resi || "-"}</strong></td>
             <td>${order.buyer || "-"}</td>
@@ -448,71 +525,38 @@ function updateSelesaiTable(orders) {
 // ============ ANALYTICS ============
 async function loadAnalytics() {
   try {
-    const result = await API.getShipments();
+    const result = await API.getAnalytics(6);
     if (!result.success) throw new Error(result.error);
 
-    const aktif = result.data.aktif || [];
-    const history = result.data.history || [];
-    const allShipments = [...aktif, ...history];
+    const data = result.data;
 
     // Calculate analytics data
-    const analytics = calculateAnalytics(aktif, history);
+    const analytics = calculateAnalytics(data);
 
     // Update key metrics
     updateKeyMetrics(analytics);
 
     // Update charts
-    updateRevenueChart(allShipments);
-    updateStatusChart(aktif, history);
+    updateRevenueChart(data.monthly || []);
+    updateStatusChart(data);
 
     // Update routes
-    updateTopRoutes(allShipments);
+    updateTopRoutes(data.top_routes_by_volume || []);
 
     // Update monthly summary
-    updateMonthlySummary(allShipments, history);
+    updateMonthlySummary(data.monthly || []);
   } catch (error) {
     console.error("Error loading analytics:", error);
     utils.showToast("Gagal memuat analytics", "error");
   }
 }
 
-function calculateAnalytics(aktif, history) {
-  const allShipments = [...aktif, ...history];
-
-  // Total Revenue
-  const totalRevenue = allShipments.reduce(
-    (sum, item) => sum + (item.price || 0),
-    0
-  );
+function calculateAnalytics(data) {
+  const monthly = data.monthly || [];
+  const thisMonthRevenue = monthly.length ? monthly[monthly.length - 1].revenue : 0;
+  const lastMonthRevenue = monthly.length > 1 ? monthly[monthly.length - 2].revenue : 0;
 
   // Revenue Growth
-  const now = new Date();
-  const thisMonth = now.getMonth();
-  const thisYear = now.getFullYear();
-
-  const thisMonthRevenue = allShipments
-    .filter((item) => {
-      const dateStr = item.tanggal_pembelian || item.created_at;
-      if (!dateStr) return false;
-      const date = new Date(dateStr);
-      return date.getMonth() === thisMonth && date.getFullYear() === thisYear;
-    })
-    .reduce((sum, item) => sum + (item.price || 0), 0);
-
-  const lastMonth = thisMonth === 0 ? 11 : thisMonth - 1;
-  const lastMonthYear = thisMonth === 0 ? thisYear - 1 : thisYear;
-
-  const lastMonthRevenue = allShipments
-    .filter((item) => {
-      const dateStr = item.tanggal_pembelian || item.created_at;
-      if (!dateStr) return false;
-      const date = new Date(dateStr);
-      return (
-        date.getMonth() === lastMonth && date.getFullYear() === lastMonthYear
-      );
-    })
-    .reduce((sum, item) => sum + (item.price || 0), 0);
-
   const revenueGrowth =
     lastMonthRevenue > 0
       ? Math.round(
@@ -522,38 +566,12 @@ function calculateAnalytics(aktif, history) {
       ? 100
       : 0;
 
-  // Average Delivery Time
-  const shipmentsWithEta = allShipments.filter((item) => item.eta_days);
-  const avgDelivery =
-    shipmentsWithEta.length > 0
-      ? Math.round(
-          shipmentsWithEta.reduce(
-            (sum, item) => sum + (item.eta_days || 0),
-            0
-          ) / shipmentsWithEta.length
-        )
-      : 0;
-
-  // Success Rate
-  const successRate =
-    allShipments.length > 0
-      ? Math.round((history.length / allShipments.length) * 100)
-      : 0;
-
-  // Active Routes
-  const routesSet = new Set();
-  allShipments.forEach((item) => {
-    if (item.route_origin && item.route_dest) {
-      routesSet.add(`${item.route_origin}-${item.route_dest}`);
-    }
-  });
-
   return {
-    totalRevenue,
+    totalRevenue: data.revenue_total || 0,
     revenueGrowth,
-    avgDelivery,
-    successRate,
-    activeRoutes: routesSet.size,
+    avgDelivery: data.avg_eta_days || 0,
+    successRate: data.completion_rate || 0,
+    activeRoutes: data.active_routes || 0,
   };
 }
 
@@ -656,24 +674,11 @@ function animateValue(
   }, 16);
 }
 
-function updateRevenueChart(shipments) {
+function updateRevenueChart(months) {
   const ctx = document.getElementById("revenueChart");
   if (!ctx) return;
 
-  const months = API.groupByMonth(shipments, 6);
-
-  // Calculate revenue per month
-  const revenueData = months.map((month) => {
-    const monthShipments = shipments.filter((item) => {
-      const dateStr = item.tanggal_pembelian || item.created_at;
-      if (!dateStr) return false;
-      const date = new Date(dateStr);
-      return (
-        date.getMonth() === month.month && date.getFullYear() === month.year
-      );
-    });
-    return monthShipments.reduce((sum, item) => sum + (item.price || 0), 0);
-  });
+  const revenueData = months.map((month) => month.revenue || 0);
 
   if (revenueChartInstance) {
     revenueChartInstance.destroy();
@@ -720,25 +725,16 @@ function updateRevenueChart(shipments) {
   });
 }
 
-function updateStatusChart(aktif, history) {
+function updateStatusChart(data) {
   const ctx = document.getElementById("statusChart");
   if (!ctx) return;
 
   const statusCounts = {
-    "Dalam Proses": 0,
-    "Dalam Pengiriman": 0,
-    Selesai: history.length,
+    "Dalam Proses": data.proses || 0,
+    "Dalam Pengiriman": data.kirim || 0,
+    Selesai: data.selesai || 0,
   };
 
-  aktif.forEach((item) => {
-    const status = item.status || "";
-    if (status === "Pesanan anda sedang kami proses") {
-      statusCounts["Dalam Proses"]++;
-    } else {
-      statusCounts["Dalam Pengiriman"]++;
-    }
-  });
-
   if (statusChartInstance) {
     statusChartInstance.destroy();
   }
@@ -784,19 +780,13 @@ function updateStatusChart(aktif, history) {
   });
 }
 
-function updateTopRoutes(shipments) {
+function updateTopRoutes(routes) {
   const routesEl = document.getElementById("top-routes");
   if (!routesEl) return;
 
-  const routeCounts = {};
-  shipments.forEach((item) => {
-    const route = `${item.route_origin || "-"} → ${item.route_dest || "-"}`;
-    routeCounts[route] = (routeCounts[route] || 0) + 1;
-  });
-
-  const sortedRoutes = Object.entries(routeCounts)
-    .sort((a, b) => b[1] - a[1])
-    .slice(0, 5);
+  const sortedRoutes = routes
+    .slice(0, 5)
+    .map((r) => [`${r.origin || "-"} → ${r.destination || "-"}`, r.count]);
 
   if (sortedRoutes.length === 0) {
     routesEl.innerHTML =
@@ -819,31 +809,14 @@ function updateTopRoutes(shipments) {
     .join("");
 }
 
-function updateMonthlySummary(allShipments, history) {
-  const now = new Date();
-  const thisMonth = now.getMonth();
-  const thisYear = now.getFullYear();
+function updateMonthlySummary(months) {
+  const thisMonth = months.length
+    ? months[months.length - 1]
+    : { count: 0, revenue: 0, completed: 0 };
 
-  const thisMonthShipments = allShipments.filter((item) => {
-    const dateStr = item.tanggal_pembelian || item.created_at;
-    if (!dateStr) return false;
-    const date = new Date(dateStr);
-    return date.getMonth() === thisMonth && date.getFullYear() === thisYear;
-  });
-
-  const thisMonthCompleted = history.filter((item) => {
-    const dateStr = item.tanggal_pembelian || item.created_at;
-    if (!dateStr) return false;
-    const date = new Date(dateStr);
-    return date.getMonth() === thisMonth && date.getFullYear() === thisYear;
-  });
-
-  const monthlyTotal = thisMonthShipments.length;
-  const monthlyRevenue = thisMonthShipments.reduce(
-    (sum, item) => sum + (item.price || 0),
-    0
-  );
-  const monthlyCompleted = thisMonthCompleted.length;
+  const monthlyTotal = thisMonth.count || 0;
+  const monthlyRevenue = thisMonth.revenue || 0;
+  const monthlyCompleted = thisMonth.completed || 0;
   const monthlyCompletionRate =
     monthlyTotal > 0 ? Math.round((monthlyCompleted / monthlyTotal) * 100) : 0;
 
@@ -919,6 +892,61 @@ document
     }
   });
 
+// ============ BULK STATUS UPDATE ============
+function updateBulkSelection() {
+  const count = document.getElementById("bulk-count");
+  const btn = document.getElementById("btn-bulk-status");
+  const all = document.getElementById("select-all-aktif");
+  if (count) count.textContent = selectedAktif.size;
+  if (btn) btn.disabled = selectedAktif.size === 0;
+  if (all && selectedAktif.size === 0) all.checked = false;
+}
+
+document
+  .getElementById("table-aktif-tbody")
+  ?.addEventListener("change", (e) => {
+    if (!e.target.classList.contains("select-aktif")) return;
+    if (e.target.checked) selectedAktif.add(e.target.value);
+    else selectedAktif.delete(e.target.value);
+    updateBulkSelection();
+  });
+
+document
+  .getElementById("select-all-aktif")
+  ?.addEventListener("change", (e) => {
+    document.querySelectorAll("#table-aktif-tbody .select-aktif").forEach((cb) => {
+      cb.checked = e.target.checked;
+      if (cb.checked) selectedAktif.add(cb.value);
+      else selectedAktif.delete(cb.value);
+    });
+    updateBulkSelection();
+  });
+
+document
+  .getElementById("btn-bulk-status")
+  ?.addEventListener("click", async () => {
+    const newStatus = document.getElementById("bulk-status").value;
+    if (!newStatus) {
+      utils.showToast("Pilih status tujuan terlebih dahulu", "error");
+      return;
+    }
+    if (!confirm(`Ubah ${selectedAktif.size} pesanan ke "${newStatus}"?`)) return;
+
+    const result = await API.bulkUpdateStatus([...selectedAktif], newStatus);
+    if (!result.success) {
+      utils.showToast(result.error, "error");
+      return;
+    }
+    const { ok, failed } = result.data;
+    utils.showToast(
+      failed ? `${ok} pesanan diupdate, ${failed} gagal` : `${ok} pesanan berhasil diupdate!`,
+      failed ? "error" : "success"
+    );
+    selectedAktif.clear();
+    loadDashboard();
+    loadKelolaPesanan();
+  });
+
 window.confirmDelete = async function (docId) {
   if (!confirm("Yakin ingin memindahkan pesanan ini ke histori?")) return;
   try {
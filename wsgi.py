@@ -0,0 +1,4 @@
+"""Entry point WSGI: `gunicorn wsgi:app`. Thread latar dijalankan sekali per proses worker."""
+from app import app, start_background
+
+start_background()